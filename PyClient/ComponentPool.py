@@ -0,0 +1,150 @@
+import json
+import os
+
+from computer.Component import clone, template_key
+
+
+class InvalidComponent(Exception): pass
+
+
+class ComponentPool:
+    """
+    In-memory catalog of the component pool
+
+    The pool folder holds a folder per module with one json file per component, it is read and
+        validated once so computers can be created without touching the disk
+    """
+
+    def __init__(self, path, cache=None):
+        """
+        Load the catalog
+        :param path: filepath of the component pool
+        :param cache: optional filepath of a pre-parsed catalog, rebuilt when the pool changes
+        :return:
+        """
+        self.__path = path
+        self.__cache = cache
+        self.__modules = {}
+        self.__keys = {}
+
+        self.load()
+
+    def signature(self):
+        """
+        Modification times of every module folder and component file in the pool
+        :return:
+        """
+        signature = {}
+
+        for module in sorted(os.listdir(self.__path)):
+            loc = os.path.join(self.__path, module)
+            if not os.path.isdir(loc):
+                continue
+
+            signature[module] = os.stat(loc).st_mtime_ns
+            for component in os.listdir(loc):
+                signature[os.path.join(module, component)] = os.stat(os.path.join(loc, component)).st_mtime_ns
+
+        return signature
+
+    def load(self):
+        """
+        Load the catalog from the cache if it's still valid, otherwise from the pool
+        :return:
+        """
+        signature = self.signature()
+
+        if self.__cache and os.path.isfile(self.__cache):
+            try:
+                f = open(self.__cache)
+                cached = json.load(f)
+                f.close()
+
+                if cached.get('signature') == signature:
+                    self.__modules = cached['modules']
+                    self.index()
+                    return
+            except ValueError:
+                # Broken cache, just rebuild it
+                pass
+
+        self.scan()
+        self.index()
+
+        if self.__cache:
+            f = open(self.__cache, "w")
+            json.dump({'signature': signature, 'modules': self.__modules}, f)
+            f.close()
+
+    def scan(self):
+        """
+        Read and validate every component in the pool
+        :return:
+        """
+        self.__modules = {}
+
+        for module in sorted(os.listdir(self.__path)):
+            loc = os.path.join(self.__path, module)
+            if not os.path.isdir(loc):
+                continue
+
+            blocks = []
+            for component in sorted(os.listdir(loc)):
+                fp = os.path.join(loc, component)
+
+                try:
+                    f = open(fp)
+                    block = json.load(f)
+                    f.close()
+                except ValueError:
+                    raise InvalidComponent(fp + " is not valid json")
+
+                if not isinstance(block, dict):
+                    raise InvalidComponent(fp + " is not a component object")
+
+                blocks.append(block)
+
+            if not blocks:
+                raise InvalidComponent(loc + " has no components")
+
+            self.__modules[module] = blocks
+
+    def index(self):
+        """
+        Work out the template key of every component once, instead of for every computer it goes into
+        :return:
+        """
+        self.__keys = {m: [template_key(block) for block in self.__modules[m]] for m in self.__modules}
+
+    def modules(self):
+        """
+        Names of every module in the pool
+        :return:
+        """
+        return self.__modules.keys()
+
+    def components(self, module):
+        """
+        Every component available for a module, these are shared so copy before changing them
+        :param module: module name
+        :return:
+        """
+        return self.__modules[module]
+
+    def component(self, module, index):
+        """
+        Fresh copy of a component
+        :param module: module name
+        :param index: which component of the module
+        :return:
+        """
+        return clone(self.__modules[module][index])
+
+    def key(self, module, index):
+        """
+        Template key of a component
+        :param module: module name
+        :param index: which component of the module
+        :return:
+        """
+        return self.__keys[module][index]
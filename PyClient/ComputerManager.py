@@ -1,14 +1,38 @@
 # Inventory Client Dep
+from computer import Clock
+from computer import FileSystem
+from computer.Component import SerialAllocator
 from computer.System import System
 from computer.invsys.InvSys import InvSys
+from computer.invsys import Logger
+from computer.invsys import SqlBroker
 from Simulation import Simluation, GUISim
+from Scheduler import Scheduler, AsyncScheduler
+from Sharding import ShardPool
+from ComponentPool import ComponentPool
+from FleetStore import open_store, StoredSystem
 
 # Python Dep
 import sys
 import os
 import string
 import random
+import gc
 import json
+import time
+import multiprocessing
+
+
+def assemble_batch(batch):
+    """
+    Assemble a batch of computers inside a worker process
+    :param batch: tuple of the component pool, computer serials and the component serial range
+    :return: list of systems
+    """
+    pool, serials, gen = batch
+    components = SerialAllocator(7, gen[0], gen[1], gen[2])
+
+    return [Manager.assemble(pool, serial, components) for serial in serials]
 
 
 class Manager:
@@ -22,46 +46,39 @@ class Manager:
         self.__systems = {}
         self.__config = config
 
+        self.__clock = self.clock(config)
+        self.__checkpoint = time.time()
+        self.__shards = None
+        self.budget(config)
+        self.connections(config)
+        self.shared_files(config)
+
         setup = self.__config['setup']
-        store = self.__config['store']
 
-        # Make storage folder if no folder exists
-        if not os.path.isdir(store):
-            os.makedirs(store)
+        # Where the computers are kept between runs
+        self.__store = open_store(self.__config)
 
         # Remove all previous computers
         if setup == 1:
-            for f in os.listdir(store):
-                fp = os.path.join(store, f)
-                if os.path.isfile(fp):
-                    try:
-                        os.unlink(fp)
-                    except PermissionError:
-                        print("Cannot delete files!")
-
-        # Load as many computers as we can
+            self.__store.clear()
+
+        # Index as many computers as we can, they're only built once they're needed
         elif setup == 2 or setup == 3:
-            comps = 0
-            for i, f in enumerate(os.listdir(store)):
-                # Only load .computer files
-                if f.endswith('computer'):
-                    if comps + 1 <= self.__config['system_count'] or setup == 3:
-                        system = self.load_computer(os.path.join(store, f))
-                        self.__systems[system.get_serial()] = system
-                        comps += 1
-
-        # Read inventory software
-        f = open(self.__config['inv_path'])
-        invconf = f.read()
-        f.close()
+            limit = None if setup == 3 else self.__config['system_count']
+            for serial, summary in self.__store.index(limit):
+                self.__systems[serial] = StoredSystem(serial, summary)
+
+        # Unique serials for computers and their generated components
+        self.__serials = SerialAllocator(6, taken=set(self.__store.serials()))
+        self.__components = SerialAllocator(7)
 
         # Create computers up to the limit
         if self.__config['system_count'] - len(self.__systems) > 0 and not setup == 3:
-            for i in range(self.__config['system_count']):
-                system = self.create_computer(self.__config['pool'])
+            # Read the component pool once
+            pool = ComponentPool(self.__config['pool'], self.__config.get('pool_cache', None))
 
-                # Add inventory config to computer
-                system.addfile('invconf', invconf)
+            # The inventory config is shared, every computer has it without its own copy
+            for system in self.create_computers(pool, self.__config['system_count']):
                 self.__systems[system.get_serial()] = system
 
         # Check if there are computers to simulate
@@ -71,6 +88,61 @@ class Manager:
 
         self.save_all_systems()
 
+    @staticmethod
+    def clock(config):
+        """
+        Simulated delays either block or advance a virtual clock
+        :param config: configuration object
+        :return:
+        """
+        if config.get('clock', 'wall') == 'virtual':
+            return Clock.VirtualClock()
+
+        return Clock.wallclock
+
+    @staticmethod
+    def budget(config):
+        """
+        Put the files of every computer in this process under a memory budget, if one is configured
+        :param config: configuration object
+        :return:
+        """
+        FileSystem.limit(config.get('fs_budget', None), config.get('fs_spill', None))
+
+    @staticmethod
+    def connections(config):
+        """
+        Limit how many client databases this process keeps open at once, whether their writes are
+            made off the tick path and how many statements each connection keeps prepared
+        :param config: configuration object
+        :return:
+        """
+        SqlBroker.limit(config.get('sql_connections', 128))
+        SqlBroker.write_behind(config.get('sql_write_behind', False))
+        SqlBroker.cache_statements(config.get('sql_cached_statements', 128))
+
+    @staticmethod
+    def connection_stats():
+        """
+        Close the pooled client database connections and report how the pool did
+        :return:
+        """
+        SqlBroker.pool.close()
+        print("SQL connections", SqlBroker.pool.stats())
+
+    @staticmethod
+    def shared_files(config):
+        """
+        Read the files every computer shares, like the inventory config, into the base layer of their filesystems
+        :param config: configuration object
+        :return:
+        """
+        f = open(config['inv_path'])
+        invconf = f.read()
+        f.close()
+
+        FileSystem.share({'invconf': invconf})
+
     @staticmethod
     def string_generator(length):
         """
@@ -83,52 +155,83 @@ class Manager:
     def create_computer(self, pool):
         """
         Create a computer using the component pool given
-        :param pool: filepath of the components
+        :param pool: ComponentPool catalog of the components
         :return:
         """
+        return self.assemble(pool, self.__serials.next(), self.__components)
 
-        serial = None
+    def create_computers(self, pool, count):
+        """
+        Create many computers at once, split across worker processes when configured
+        :param pool: ComponentPool catalog of the components
+        :param count: how many computers
+        :return: list of systems
+        """
+        processes = self.__config.get('generate_processes', 1)
+        serials = self.__serials.batch(count)
 
-        # Generate a serial number which is not present
-        while True:
-            serial = self.string_generator(6)
-            if serial not in self.__systems:
-                break
+        # Lots of small objects, the garbage collector would rescan all of them over and over
+        collect = gc.isenabled()
+        gc.disable()
 
-        system = System()
+        try:
+            if processes <= 1 or count < processes:
+                return [self.assemble(pool, serial, self.__components) for serial in serials]
+
+            # Every batch gets its own range of component serials so no two processes hand out the same one
+            per_computer = sum(len(pool.components(m)) if m == 'partitions' else 1 for m in pool.modules())
+            size = -(-count // (processes * 4))
+            offset = self.__components.offset
+
+            batches = []
+            for start in range(0, count, size):
+                gen = self.__components.reserve(size * per_computer) + (offset,)
+                batches.append((pool, serials[start:start + size], gen))
 
-        # Get list of modules
-        modules = os.listdir(pool)
+            workers = multiprocessing.Pool(processes)
+            systems = []
+            for batch in workers.imap(assemble_batch, batches):
+                systems.extend(batch)
 
-        for component in modules:
-            loc = os.path.join(pool, component)
-            locs = os.listdir(loc)
-            comploc = []
+            workers.close()
+            workers.join()
+
+            return systems
+        finally:
+            if collect:
+                gc.enable()
+
+    @staticmethod
+    def assemble(pool, serial, components):
+        """
+        Assemble a computer from the component pool
+        :param pool: ComponentPool catalog of the components
+        :param serial: serial of the computer
+        :param components: SerialAllocator for generated component serials
+        :return:
+        """
+        system = System()
+
+        for component in pool.modules():
+            choices = range(len(pool.components(component)))
 
             # Specifically load more than 1 component for partitions
-            if component == 'partitions':
-                for i in locs:
-                    comploc.append(os.path.join(loc, i))
-            else:
-                # Component location
-                comploc.append(os.path.join(loc, random.choice(locs)))
+            if component != 'partitions':
+                choices = [random.choice(choices)]
 
             # For all comonents load them into system
-            for i in comploc:
-                # Load components
-                f = open(i)
-                block = json.load(f)
-                f.close()
+            for i in choices:
+                block = pool.component(component, i)
 
                 if 'serial' in block:
                     if block['serial'] == 'GEN':
-                        block['serial'] = self.string_generator(7)
+                        block['serial'] = components.next()
 
                 # If it's the bios, give it our custom serial
                 if component == 'bios':
                     block['serial'] = serial
 
-                system.add_component(component, block)
+                system.add_component(component, block, pool.key(component, i))
 
         return system
 
@@ -147,6 +250,15 @@ class Manager:
         computer = json.load(f)
         f.close()
 
+        return Manager.build_computer(computer)
+
+    @staticmethod
+    def build_computer(computer):
+        """
+        Build a computer from its decoded .computer structure
+        :param computer: dictionary of modules and filesystem
+        :return:
+        """
         system = System()
 
         # Load system components
@@ -154,68 +266,210 @@ class Manager:
             for j in computer['modules'][i]:
                 system.add_component(i, j)
 
-        # Load all files into computers
-        for x in computer['filesystem']:
-            system.addfile(x, computer['filesystem'][x])
+        # Load all files into computers, on top of the files every computer shares
+        system.restore_files(computer['filesystem'], computer.get('whiteouts', ()))
+
+        return system
+
+    def system(self, serial):
+        """
+        Get a system, building it from the fleet store if it hasn't been yet
+        :param serial: system serial
+        :return:
+        """
+        system = self.__systems.get(serial, None)
+
+        if isinstance(system, StoredSystem):
+            system = self.build_computer(json.loads(self.__store.load(serial)))
+            system.clean()
+            self.__systems[serial] = system
 
         return system
 
     def save(self, system):
         """
-        Save system to .computer file
+        Save system to the fleet store
         :param system: system to save to the filestore
         :return:
         """
-        filename = os.path.join(self.__config['store'], system.get_serial() + '.computer')
-
-        fp = open(filename, "w")
-        fp.write(str(system))
-        fp.close()
+        version = system.version()
+        self.__store.save(system.get_serial(), str(system), json.dumps(system.summary()))
+        system.clean(version)
 
     def save_all_systems(self):
         """
-        Mass save all systems
+        Mass save all systems which changed since they were last saved
         :return:
         """
+        saved = []
+        computers = []
+
+        # Queued log records belong in the saved computers
+        Logger.flush_all()
+
         for i in self.__systems:
-            self.save(self.__systems[i])
+            system = self.__systems[i]
+            if not system.dirty:
+                continue
 
-    def run(self):
+            version = system.version()
+            try:
+                computers.append((i, str(system), json.dumps(system.summary())))
+            except RuntimeError:
+                # Changed while being serialized, it stays dirty for the next save
+                continue
+
+            saved.append((system, version))
+
+        self.__store.save_many(computers)
+
+        for system, version in saved:
+            system.clean(version)
+
+    def checkpoint(self):
         """
-        Start simulation of computers
+        Save changed systems every so often while the simulation runs
         :return:
         """
+        interval = self.__config.get('checkpoint', None)
+        if not interval or time.time() < self.__checkpoint + interval:
+            return
 
-        threads = {}
-        ticktime = self.__config['tickrate']
+        self.__checkpoint = time.time()
+        self.save_all_systems()
+        SqlBroker.flush()
+        SqlBroker.snapshot_all()
 
-        # Generate the threads for each system
-        for i, comp in enumerate(self.__systems):
-            system = self.__systems[comp]
+        # Sharded systems are saved by their shard, we only store them
+        if self.__shards:
+            saved = self.__shards.saved()
+            self.__store.save_many((serial,) + saved[serial] for serial in saved)
+            for serial in saved:
+                self.__systems[serial] = StoredSystem(serial, saved[serial][1])
 
-            # Install software
+    @staticmethod
+    def simulators(config, systems, clock):
+        """
+        Install the software on the systems and create the threads which simulate them
+        :param config: configuration object
+        :param systems: dictionary of systems to simulate
+        :param clock: Clock the systems run on
+        :return: dictionary of simulation threads
+        """
+        threads = {}
+        ticktime = config['tickrate']
+
+        # Install software
+        for comp in systems:
+            system = systems[comp]
             system.install_software(InvSys, [system])
 
-            threads[system.get_serial()] = Simluation(i, system.get_serial(), ticktime, system)
+        scheduler = config.get('scheduler', 'thread')
+
+        if scheduler == 'asyncio':
+            # Every system is a coroutine on one asyncio event loop
+            threads['scheduler'] = AsyncScheduler(0, "AsyncScheduler", ticktime, list(systems.values()),
+                                                  config.get('inflight', 100), clock,
+                                                  config.get('duration', None))
+        # A virtual clock only makes sense when one scheduler decides what happens next
+        elif clock.virtual or scheduler == 'event':
+            # One event loop drives every system
+            threads['scheduler'] = Scheduler(0, "Scheduler", ticktime, list(systems.values()),
+                                             config.get('workers', 1), clock,
+                                             config.get('duration', None))
+        else:
+            # Generate the threads for each system
+            for i, comp in enumerate(systems):
+                system = systems[comp]
+                threads[system.get_serial()] = Simluation(i, system.get_serial(), ticktime, system)
+
+        return threads
+
+    def run(self):
+        """
+        Start simulation of computers
+        :return:
+        """
+        shards = None
+
+        if self.__config.get('processes', 1) > 1:
+            # Worker processes own the systems, we only see their status
+            computers = {}
+            for serial in self.__systems:
+                system = self.__systems[serial]
+                computers[serial] = self.__store.load(serial) if isinstance(system, StoredSystem) else str(system)
+
+            shards = self.__shards = ShardPool(0, "Shards", self.__config, computers, self.__config['processes'])
+            threads = {'shards': shards}
+            systems = shards.statuses
+        else:
+            # Every simulated system has to be built
+            systems = {serial: self.system(serial) for serial in self.__systems}
+            threads = self.simulators(self.__config, systems, self.__clock)
 
         # Start processing each computer independently
         for i in threads:
             threads[i].start()
 
-        # Start the GUI
-        gui = GUISim(0, "Inventory Simulation", self.__systems, ticktime)
-        gui.start()
-
-        # While GUI is open, keep simulating
-        while True:
-            if gui.stopped():
-                for t in threads:
-                    threads[t].stop()
+        self.wait(threads, systems)
 
-                break
+        for t in threads:
+            threads[t].stop()
 
         # Wait for threads to exit
         for t in threads:
             threads[t].join()
 
+        # Power everything down so the software lets go of its databases
+        if not shards:
+            self.power_off(systems)
+            self.connection_stats()
+
+        # The shards hand back their systems already serialized, store them as they are
+        if shards:
+            self.__store.save_many((serial,) + shards.results[serial] for serial in shards.results)
+            for serial in shards.results:
+                self.__systems[serial] = StoredSystem(serial, shards.results[serial][1])
+
         self.save_all_systems()
+        self.__store.close()
+
+        # Everything is saved, nothing reads spilled files anymore
+        FileSystem.close()
+
+    @staticmethod
+    def power_off(systems):
+        """
+        Shut down every system which is still powered
+        :param systems: dictionary of serial to system
+        :return:
+        """
+        for serial in systems:
+            if systems[serial].parameter('powered'):
+                systems[serial].shutdown()
+
+    def wait(self, threads, systems):
+        """
+        Block while the simulation is running, either until the GUI is closed or on ctrl-c
+        :param threads: simulation threads
+        :param systems: systems shown in the GUI
+        :return:
+        """
+        if self.__config.get('gui', True):
+            # Start the GUI
+            gui = GUISim(0, "Inventory Simulation", systems, self.__config['tickrate'], self.__clock)
+            gui.start()
+
+            # While GUI is open, keep simulating
+            while not gui.stopped():
+                self.checkpoint()
+                time.sleep(0.1)
+
+            return
+
+        try:
+            while any(threads[t].is_alive() for t in threads):
+                self.checkpoint()
+                time.sleep(0.5)
+        except KeyboardInterrupt:
+            print("Stopping simulation")
@@ -0,0 +1,591 @@
+import json
+import os
+import sqlite3
+
+
+def summarize(data):
+    """
+    Module summary of a serialized computer, how many components each module has
+    :param data: json string of the computer
+    :return: json string of the summary
+    """
+    modules = json.loads(data)['modules']
+
+    return json.dumps({i: len(modules[i]) for i in modules})
+
+
+class StoredSystem:
+    """
+    Stand-in for a computer which is in the fleet store but hasn't been built, it is only as
+        heavy as its serial and module summary
+    """
+
+    def __init__(self, serial, summary=None):
+        """
+        Initialize the stand-in
+        :param serial: computer serial
+        :param summary: json string of the module summary, None if the store doesn't keep one
+        :return:
+        """
+        self.__serial = serial
+        self.__summary = summary
+        self.status = 'Stored'
+
+    def get_serial(self):
+        """
+        Get the serial of the computer
+        :return:
+        """
+        return self.__serial
+
+    @property
+    def summary(self):
+        """
+        How many components each module has
+        :return:
+        """
+        return json.loads(self.__summary) if self.__summary else None
+
+    @property
+    def dirty(self):
+        """
+        Nothing to save, the store already has it
+        :return:
+        """
+        return False
+
+    def parameter(self, key):
+        """
+        Stored computers aren't powered
+        :param key:
+        :return:
+        """
+        return False if key == 'powered' else None
+
+    def lasttick(self):
+        """
+        Stored computers never ticked
+        :return:
+        """
+        return 0
+
+
+class DirectoryStore:
+    """
+    Fleet store keeping every computer in its own <serial>.computer file
+    """
+
+    def __init__(self, path):
+        """
+        Initialize the store
+        :param path: folder the computers are kept in
+        :return:
+        """
+        self.__path = path
+
+        # Make storage folder if no folder exists
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def filepath(self, serial):
+        """
+        Filepath of a stored computer
+        :param serial: computer serial
+        :return:
+        """
+        return os.path.join(self.__path, serial + '.computer')
+
+    def serials(self):
+        """
+        Serials of every stored computer
+        :return:
+        """
+        return [f[:-len('.computer')] for f in os.listdir(self.__path) if f.endswith('.computer')]
+
+    def index(self, limit=None):
+        """
+        Serials of stored computers without loading them, files don't keep a module summary
+        :param limit: maximum amount of computers, None for all of them
+        :return: list of serial and summary pairs
+        """
+        return [(serial, None) for serial in self.serials()[:limit]]
+
+    def load(self, serial):
+        """
+        Load a stored computer
+        :param serial: computer serial
+        :return: json string of the computer, None if it isn't stored
+        """
+        fp = self.filepath(serial)
+        if not os.path.isfile(fp):
+            return None
+
+        f = open(fp)
+        data = f.read()
+        f.close()
+
+        return data
+
+    def load_all(self, limit=None):
+        """
+        Load stored computers
+        :param limit: maximum amount of computers, None for all of them
+        :return: generator of serial and json string pairs
+        """
+        for i, serial in enumerate(self.serials()):
+            if limit is not None and i >= limit:
+                return
+
+            yield serial, self.load(serial)
+
+    def save(self, serial, data, summary=None):
+        """
+        Save a computer
+        :param serial: computer serial
+        :param data: json string of the computer
+        :param summary: json string of the module summary
+        :return:
+        """
+        fp = open(self.filepath(serial), "w")
+        fp.write(data)
+        fp.close()
+
+    def save_many(self, computers):
+        """
+        Save many computers
+        :param computers: iterable of serial, json string and summary tuples
+        :return:
+        """
+        for serial, data, summary in computers:
+            self.save(serial, data, summary)
+
+    def clear(self):
+        """
+        Remove all previous computers, along with anything else in the folder
+        :return:
+        """
+        for f in os.listdir(self.__path):
+            fp = os.path.join(self.__path, f)
+            if os.path.isfile(fp):
+                try:
+                    os.unlink(fp)
+                except PermissionError:
+                    print("Cannot delete files!")
+
+    def close(self):
+        """
+        Nothing is held open
+        :return:
+        """
+        pass
+
+
+class SqliteStore:
+    """
+    Fleet store keeping every computer in one SQLite database, a row per computer
+    """
+
+    def __init__(self, path, filename='fleet.db3'):
+        """
+        Open the store, computers in an existing .computer folder are migrated when it's first created
+        :param path: folder the database is kept in
+        :param filename: name of the database file
+        :return:
+        """
+        self.__path = path
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        fp = os.path.join(path, filename)
+        created = not os.path.exists(fp)
+
+        self.__conn = sqlite3.connect(fp)
+        self.__conn.execute('PRAGMA journal_mode=WAL')
+        self.__conn.execute('PRAGMA synchronous=NORMAL')
+        self.__conn.execute('CREATE TABLE IF NOT EXISTS systems '
+                            '(serial VARCHAR(20) PRIMARY KEY, '
+                            'data TEXT, '
+                            'summary TEXT)')
+
+        # Stores made before the summary was kept
+        columns = [row[1] for row in self.__conn.execute('PRAGMA table_info(systems)')]
+        if 'summary' not in columns:
+            self.__conn.execute('ALTER TABLE systems ADD COLUMN summary TEXT')
+
+        # Lets the index be read without paging through every computer's data
+        self.__conn.execute('CREATE INDEX IF NOT EXISTS systems_summary ON systems (serial, summary)')
+
+        self.__conn.commit()
+
+        if created:
+            self.migrate(DirectoryStore(path))
+
+    def migrate(self, store):
+        """
+        Copy every computer of another store that isn't in this one yet
+        :param store: store to migrate from
+        :return: amount of computers migrated
+        """
+        known = set(self.serials())
+        missing = [(serial, data, summarize(data)) for serial, data in store.load_all() if serial not in known]
+
+        if missing:
+            print("Migrating", len(missing), "computers to the fleet store")
+            self.save_many(missing)
+
+        return len(missing)
+
+    def serials(self):
+        """
+        Serials of every stored computer
+        :return:
+        """
+        return [row[0] for row in self.__conn.execute('SELECT serial FROM systems')]
+
+    def index(self, limit=None):
+        """
+        Serials and module summaries of stored computers without loading them
+        :param limit: maximum amount of computers, None for all of them
+        :return: list of serial and summary pairs
+        """
+        query = 'SELECT serial, summary FROM systems'
+        if limit is not None:
+            query += ' LIMIT ' + str(int(limit))
+
+        return self.__conn.execute(query).fetchall()
+
+    def load(self, serial):
+        """
+        Load a stored computer
+        :param serial: computer serial
+        :return: json string of the computer, None if it isn't stored
+        """
+        row = self.__conn.execute('SELECT data FROM systems WHERE serial = ?', [serial]).fetchone()
+
+        return row[0] if row else None
+
+    def load_all(self, limit=None):
+        """
+        Load stored computers
+        :param limit: maximum amount of computers, None for all of them
+        :return: generator of serial and json string pairs
+        """
+        query = 'SELECT serial, data FROM systems'
+        if limit is not None:
+            query += ' LIMIT ' + str(int(limit))
+
+        for row in self.__conn.execute(query):
+            yield row[0], row[1]
+
+    def save(self, serial, data, summary=None):
+        """
+        Save a computer
+        :param serial: computer serial
+        :param data: json string of the computer
+        :param summary: json string of the module summary
+        :return:
+        """
+        self.save_many([(serial, data, summary)])
+
+    def save_many(self, computers):
+        """
+        Save many computers in one transaction
+        :param computers: iterable of serial, json string and summary tuples
+        :return:
+        """
+        with self.__conn:
+            self.__conn.executemany('INSERT OR REPLACE INTO systems (serial, data, summary) VALUES (?, ?, ?)',
+                                    computers)
+
+    def clear(self):
+        """
+        Remove all previous computers
+        :return:
+        """
+        with self.__conn:
+            self.__conn.execute('DELETE FROM systems')
+
+    def close(self):
+        """
+        Close the database
+        :return:
+        """
+        self.__conn.close()
+
+
+class JournalStore:
+    """
+    Fleet store appending every saved computer to one journal file
+
+    Each record is a line of the serial, module summary and computer json separated by tabs, the
+        newest record of a serial wins. An index of where each computer's newest record sits is kept
+        next to the journal when it's closed, so opening only has to scan what was appended since, and
+        the journal is compacted down to the live records once it grows too far past them
+    """
+
+    def __init__(self, path, filename='fleet.journal', ratio=2, minimum=1 << 20):
+        """
+        Open the journal
+        :param path: folder the journal is kept in
+        :param filename: name of the journal file
+        :param ratio: compact once the journal is this many times bigger than the live records
+        :param minimum: never compact journals smaller than this many bytes
+        :return:
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.__fp = os.path.join(path, filename)
+        self.__idx = self.__fp + '.idx'
+        self.__ratio = ratio
+        self.__minimum = minimum
+        self.__index = {}
+        self.__live = 0
+
+        # Create it if it doesn't exist
+        open(self.__fp, 'ab').close()
+
+        self.scan(self.read_index())
+        self.__journal = open(self.__fp, 'r+b')
+        self.__journal.seek(0, os.SEEK_END)
+
+    def read_index(self):
+        """
+        Load the index saved when the journal was last closed
+        :return: how far into the journal the index covers
+        """
+        self.__index = {}
+        self.__live = 0
+
+        if not os.path.isfile(self.__idx):
+            return 0
+
+        try:
+            f = open(self.__idx)
+            saved = json.load(f)
+            f.close()
+        except ValueError:
+            return 0
+
+        # The journal was cut short since, nothing in the index can be trusted
+        if saved['size'] > os.path.getsize(self.__fp):
+            return 0
+
+        self.__index = {serial: tuple(record) for serial, record in saved['index'].items()}
+        self.__live = saved['live']
+
+        return saved['size']
+
+    def write_index(self):
+        """
+        Save the index next to the journal
+        :return:
+        """
+        tmp = self.__idx + '.tmp'
+
+        f = open(tmp, 'w')
+        json.dump({'size': os.path.getsize(self.__fp), 'live': self.__live, 'index': self.__index}, f)
+        f.close()
+
+        os.replace(tmp, self.__idx)
+
+    def remove_index(self):
+        """
+        Remove the saved index, the journal is about to change under it
+        :return:
+        """
+        if os.path.isfile(self.__idx):
+            os.unlink(self.__idx)
+
+    def scan(self, offset=0):
+        """
+        Build the index of the newest record of each computer
+        :param offset: where to start scanning, the index already covers everything before it
+        :return:
+        """
+        if not offset:
+            self.__index = {}
+            self.__live = 0
+
+        f = open(self.__fp, 'rb')
+        f.seek(offset)
+        for line in f:
+            # A record cut short by a crash is thrown away
+            if not line.endswith(b'\n'):
+                break
+
+            raw, _, rest = line.partition(b'\t')
+            summary, sep, data = rest.partition(b'\t')
+            serial = raw.decode('utf-8')
+
+            # Records written before summaries were kept
+            if not sep:
+                summary, data = b'', summary
+
+            if serial in self.__index:
+                self.__live -= self.__index[serial][1]
+
+            start = offset + len(line) - len(data)
+            self.__index[serial] = (start, len(data) - 1, summary.decode('utf-8') or None)
+            self.__live += len(data) - 1
+            offset += len(line)
+        f.close()
+
+        # Drop the broken tail
+        if offset != os.path.getsize(self.__fp):
+            f = open(self.__fp, 'r+b')
+            f.truncate(offset)
+            f.close()
+
+    def serials(self):
+        """
+        Serials of every stored computer
+        :return:
+        """
+        return list(self.__index.keys())
+
+    def index(self, limit=None):
+        """
+        Serials and module summaries of stored computers without loading them
+        :param limit: maximum amount of computers, None for all of them
+        :return: list of serial and summary pairs
+        """
+        return [(serial, self.__index[serial][2]) for serial in list(self.__index.keys())[:limit]]
+
+    def load(self, serial):
+        """
+        Load a stored computer
+        :param serial: computer serial
+        :return: json string of the computer, None if it isn't stored
+        """
+        if serial not in self.__index:
+            return None
+
+        offset, length, summary = self.__index[serial]
+
+        f = open(self.__fp, 'rb')
+        f.seek(offset)
+        data = f.read(length)
+        f.close()
+
+        return data.decode('utf-8')
+
+    def load_all(self, limit=None):
+        """
+        Load stored computers
+        :param limit: maximum amount of computers, None for all of them
+        :return: generator of serial and json string pairs
+        """
+        f = open(self.__fp, 'rb')
+
+        for i, serial in enumerate(list(self.__index.keys())):
+            if limit is not None and i >= limit:
+                break
+
+            offset, length, summary = self.__index[serial]
+            f.seek(offset)
+            yield serial, f.read(length).decode('utf-8')
+
+        f.close()
+
+    def save(self, serial, data, summary=None):
+        """
+        Save a computer
+        :param serial: computer serial
+        :param data: json string of the computer
+        :param summary: json string of the module summary
+        :return:
+        """
+        self.save_many([(serial, data, summary)])
+
+    def save_many(self, computers):
+        """
+        Append many computers to the journal, synced to disk once
+        :param computers: iterable of serial, json string and summary tuples
+        :return:
+        """
+        offset = self.__journal.tell()
+        written = False
+
+        for serial, data, summary in computers:
+            head = serial.encode('utf-8') + b'\t' + (summary or '').encode('utf-8') + b'\t'
+            data = data.encode('utf-8')
+            self.__journal.write(head + data + b'\n')
+
+            if serial in self.__index:
+                self.__live -= self.__index[serial][1]
+
+            self.__index[serial] = (offset + len(head), len(data), summary)
+            self.__live += len(data)
+            offset += len(head) + len(data) + 1
+            written = True
+
+        if not written:
+            return
+
+        self.__journal.flush()
+        os.fsync(self.__journal.fileno())
+
+        if offset > self.__minimum and offset > self.__live * self.__ratio:
+            self.compact()
+
+    def compact(self):
+        """
+        Rewrite the journal with only the newest record of each computer
+        :return:
+        """
+        tmp = self.__fp + '.compact'
+        records = list(self.load_all())
+
+        f = open(tmp, 'wb')
+        for serial, data in records:
+            summary = self.__index[serial][2] or ''
+            f.write(b'\t'.join((serial.encode('utf-8'), summary.encode('utf-8'), data.encode('utf-8'))) + b'\n')
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+
+        self.__journal.close()
+        self.remove_index()
+        os.replace(tmp, self.__fp)
+
+        self.scan()
+        self.write_index()
+        self.__journal = open(self.__fp, 'r+b')
+        self.__journal.seek(0, os.SEEK_END)
+
+    def clear(self):
+        """
+        Remove all previous computers
+        :return:
+        """
+        self.remove_index()
+        self.__journal.truncate(0)
+        self.__journal.seek(0)
+        self.__index = {}
+        self.__live = 0
+
+    def close(self):
+        """
+        Close the journal, keeping its index for next time
+        :return:
+        """
+        self.__journal.close()
+        self.write_index()
+
+
+def open_store(config):
+    """
+    Open the fleet store the configuration asks for
+    :param config: configuration object
+    :return:
+    """
+    backend = config.get('store_backend', 'files')
+
+    if backend == 'sqlite':
+        return SqliteStore(config['store'])
+    elif backend == 'journal':
+        return JournalStore(config['store'])
+
+    return DirectoryStore(config['store'])
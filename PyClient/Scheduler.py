@@ -0,0 +1,324 @@
+import asyncio
+import heapq
+import itertools
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from computer import Clock
+from computer.invsys.RequestAPI import AsyncRequestApi
+
+
+class Scheduler(threading.Thread):
+    """
+    Event loop simulation of many computers
+
+    Instead of one thread per computer, every system sits in a priority queue ordered by when it is
+        next due, only the systems that are due get woken up and ticked
+
+    Delays never block the loop, a system is only due again once they're over. On a virtual clock
+        nothing sleeps at all, the clock is fast-forwarded straight to the next event
+    """
+
+    def __init__(self, threadid, name, tick, systems, workers=1, clock=None, duration=None):
+        """
+        Initialize the scheduler thread
+        :param threadid: thread id number
+        :param name: thread name
+        :param tick: tick rate
+        :param systems: list of systems this scheduler is responsible for
+        :param workers: how many worker threads tick due systems
+        :param clock: Clock to run on, defaults to the wall clock
+        :param duration: stop after this many seconds of (virtual) time, None runs until stopped
+        :return:
+        """
+        threading.Thread.__init__(self)
+        self.threadid = threadid
+        self.name = name
+        self.ticktime = tick
+        self._systems = systems
+        self._workers = max(1, int(workers))
+        self._clock = clock if clock else Clock.wallclock
+        self._duration = duration
+        self._end = None
+        self.__queue = []
+        self.__counter = itertools.count()
+        self.__lock = threading.Lock()
+        self.__wake = threading.Event()
+        self.__stop = False
+
+    def stop(self):
+        """
+        Stop the scheduler
+        :return:
+        """
+        self.__stop = True
+        self.wake()
+
+    def stopped(self):
+        """
+        Is the scheduler stopped
+        :return:
+        """
+        return self.__stop
+
+    def schedule(self, due, system, action='tick'):
+        """
+        Queue up a system to be processed at a given time
+        :param due: time the system is due
+        :param system: system to process
+        :param action: boot or tick
+        :return:
+        """
+        with self.__lock:
+            heapq.heappush(self.__queue, (due, next(self.__counter), action, system))
+
+        self.wake()
+
+    def wake(self):
+        """
+        Wake the loop up, something changed
+        :return:
+        """
+        self.__wake.set()
+
+    def due(self, now):
+        """
+        Pop every system which is due
+        :param now: current time
+        :return: list of (action, system) and time of the next event
+        """
+        events = []
+
+        with self.__lock:
+            while self.__queue and self.__queue[0][0] <= now:
+                event = heapq.heappop(self.__queue)
+                events.append((event[2], event[3]))
+
+            nxt = self.__queue[0][0] if self.__queue else None
+
+        return events, nxt
+
+    def over(self):
+        """
+        Is the simulation past its duration
+        :return:
+        """
+        return self._end is not None and self._clock.time() >= self._end
+
+    def process(self, action, system):
+        """
+        Boot or tick a system and put it back in the queue
+        :param action: boot or tick
+        :param system: system to process
+        :return:
+        """
+        if self.stopped() or self.over():
+            return
+
+        try:
+            if action == 'boot':
+                system.boot()
+            else:
+                system.tick(self._clock.time())
+        except:
+            # One crashed computer shouldn't take down the rest of the fleet
+            traceback.print_exc()
+            system.shutdown(True)
+            return
+
+        # Any delay the system went through pushes its next tick back
+        self.schedule(self._clock.resume(system.busy()) + self.ticktime, system)
+
+    def run(self):
+        """
+        Run the simulation
+        :return:
+        """
+        print("Starting scheduler for", len(self._systems), "systems")
+
+        # Systems wait out their delays in the queue instead of in the loop
+        if not self._clock.virtual:
+            self._clock = Clock.eventclock
+
+        clock = self._clock
+
+        # Everything boots straight away
+        now = clock.time()
+        end = self._end = None if self._duration is None else now + self._duration
+        for system in self._systems:
+            system.clock = clock
+            self.schedule(now, system, 'boot')
+
+        pool = None
+        if self._workers > 1:
+            pool = ThreadPoolExecutor(max_workers=self._workers)
+
+        while not self.stopped():
+            if end is not None and clock.time() >= end:
+                break
+
+            self.__wake.clear()
+            events, nxt = self.due(clock.time())
+
+            if pool:
+                futures = [pool.submit(self.process, action, system) for action, system in events]
+
+                # Virtual time can't move on until everything due right now is done
+                if clock.virtual:
+                    wait(futures)
+            else:
+                for action, system in events:
+                    if self.over():
+                        break
+                    self.process(action, system)
+
+            if events:
+                continue
+
+            if clock.virtual:
+                # Nothing left to do at this instant, skip straight to the next event
+                if nxt is None:
+                    break
+                clock.advance(nxt if end is None else min(nxt, end))
+            else:
+                # Sleep until the next system is due, the simulation is over or something new gets scheduled
+                wakeup = [i for i in (nxt, end) if i is not None]
+                timeout = max(0, min(wakeup) - clock.time()) if wakeup else None
+                self.__wake.wait(timeout)
+
+        if pool:
+            pool.shutdown(wait=True)
+
+        print("Exiting", self.name)
+
+
+class AsyncScheduler(Scheduler):
+    """
+    Event loop simulation of many computers on asyncio
+
+    Due systems are ticked as coroutines, so while one waits on the API every other system keeps going
+        and the amount of computers in flight is bounded by sockets instead of threads
+    """
+
+    def __init__(self, threadid, name, tick, systems, inflight=100, clock=None, duration=None):
+        """
+        Initialize the scheduler thread
+        :param threadid: thread id number
+        :param name: thread name
+        :param tick: tick rate
+        :param systems: list of systems this scheduler is responsible for
+        :param inflight: how many API requests can be in flight at once
+        :param clock: Clock to run on, defaults to the wall clock
+        :param duration: stop after this many seconds of (virtual) time, None runs until stopped
+        :return:
+        """
+        super().__init__(threadid, name, tick, systems, 1, clock, duration)
+        self.__inflight = inflight
+        self.__loop = None
+        self.__wake = None
+
+    def wake(self):
+        """
+        Wake the event loop up, safe to call from any thread
+        :return:
+        """
+        if not self.__loop:
+            return
+
+        if self.__loop.is_running() and threading.current_thread() is not self:
+            self.__loop.call_soon_threadsafe(self.__wake.set)
+        else:
+            self.__wake.set()
+
+    async def process_async(self, action, system):
+        """
+        Boot or tick a system and put it back in the queue
+        :param action: boot or tick
+        :param system: system to process
+        :return:
+        """
+        if self.stopped():
+            return
+
+        try:
+            if action == 'boot':
+                await system.boot_async()
+            else:
+                await system.tick_async(self._clock.time())
+        except:
+            # One crashed computer shouldn't take down the rest of the fleet
+            traceback.print_exc()
+            system.shutdown(True)
+            return
+
+        # Any delay the system went through pushes its next tick back
+        self.schedule(self._clock.resume(system.busy()) + self.ticktime, system)
+
+    async def main(self):
+        """
+        The event loop driving every system
+        :return:
+        """
+        clock = self._clock
+        tasks = set()
+
+        self.__loop = asyncio.get_running_loop()
+        self.__wake = asyncio.Event()
+        AsyncRequestApi.bound(self.__inflight)
+
+        # Everything boots straight away
+        now = clock.time()
+        end = None if self._duration is None else now + self._duration
+        for system in self._systems:
+            system.clock = clock
+            self.schedule(now, system, 'boot')
+
+        while not self.stopped():
+            if end is not None and clock.time() >= end:
+                break
+
+            self.__wake.clear()
+            events, nxt = self.due(clock.time())
+
+            for action, system in events:
+                task = asyncio.ensure_future(self.process_async(action, system))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+            if events:
+                continue
+
+            if clock.virtual:
+                # Virtual time can't move on until everything in flight is done
+                if tasks:
+                    await asyncio.wait(list(tasks))
+                    continue
+
+                # Nothing left to do at this instant, skip straight to the next event
+                if nxt is None:
+                    break
+                clock.advance(nxt if end is None else min(nxt, end))
+            else:
+                # Sleep until the next system is due, the simulation is over or something new gets scheduled
+                wakeup = [i for i in (nxt, end) if i is not None]
+                timeout = max(0, min(wakeup) - clock.time()) if wakeup else None
+                try:
+                    await asyncio.wait_for(self.__wake.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+        # Let everything in flight finish
+        if tasks:
+            await asyncio.wait(list(tasks))
+
+    def run(self):
+        """
+        Run the simulation
+        :return:
+        """
+        print("Starting asyncio scheduler for", len(self._systems), "systems")
+
+        asyncio.run(self.main())
+
+        print("Exiting", self.name)
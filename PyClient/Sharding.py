@@ -0,0 +1,300 @@
+import json
+import multiprocessing
+import queue
+import threading
+import time
+
+
+class SystemStatus:
+    """
+    What the parent process knows about a system simulated in a shard, enough to draw the GUI
+    """
+
+    def __init__(self, serial):
+        """
+        Initialize the status
+        :param serial: system serial
+        :return:
+        """
+        self.__serial = serial
+        self.status = 'Off'
+        self.__powered = False
+        self.__lasttick = 0
+
+    def update(self, status, powered, lasttick):
+        """
+        Apply a status report from the shard
+        :param status: system status
+        :param powered: is the system powered
+        :param lasttick: when the system ticked last
+        :return:
+        """
+        self.status = status
+        self.__powered = powered
+        self.__lasttick = lasttick
+
+    def get_serial(self):
+        """
+        Get the serial of the computer
+        :return:
+        """
+        return self.__serial
+
+    def parameter(self, key):
+        """
+        Get system parameter by key, only power is reported
+        :param key:
+        :return:
+        """
+        return self.__powered if key == 'powered' else None
+
+    def lasttick(self):
+        """
+        Get when the computer ticked last
+        :return:
+        """
+        return self.__lasttick
+
+
+def save_changed(systems, saves):
+    """
+    Serialize every system which changed since it was last saved and hand them to the parent
+    :param systems: dictionary of serial to system
+    :param saves: queue the serialized systems are put on
+    :return:
+    """
+    from computer.invsys import Logger
+    from computer.invsys import SqlBroker
+
+    # Queued log records belong in the saved computers, queued writes in the databases
+    Logger.flush_all()
+    SqlBroker.flush()
+    SqlBroker.snapshot_all()
+
+    computers = {}
+    for serial in systems:
+        system = systems[serial]
+        if not system.dirty:
+            continue
+
+        version = system.version()
+        try:
+            computers[serial] = (str(system), json.dumps(system.summary()))
+        except RuntimeError:
+            # Changed while being serialized, it stays dirty for the next save
+            continue
+
+        system.clean(version)
+
+    if computers:
+        saves.put(computers)
+
+
+def shard_worker(shard, config, computers, status, results, stop, saves):
+    """
+    Simulate a subset of the fleet inside a worker process
+
+    The worker owns its systems, their software and SQLite files, and reports status changes back to
+        the parent until told to stop, then returns every system serialized along with its module summary
+    :param shard: shard number
+    :param config: simulation configuration
+    :param computers: list of serialized systems to simulate
+    :param status: queue status reports are put on
+    :param results: queue the serialized systems are put on when done
+    :param stop: event set by the parent when the simulation should stop
+    :param saves: queue changed systems are put on every checkpoint
+    :return:
+    """
+    from ComputerManager import Manager
+    from computer import FileSystem
+    from computer.invsys import Logger
+
+    Manager.budget(config)
+    Manager.connections(config)
+    Manager.shared_files(config)
+
+    systems = {}
+    for computer in computers:
+        system = Manager.build_computer(json.loads(computer))
+        systems[system.get_serial()] = system
+
+    threads = Manager.simulators(config, systems, Manager.clock(config))
+    for t in threads:
+        threads[t].start()
+
+    interval = config.get('checkpoint', None)
+    checkpoint = time.time()
+
+    reported = {}
+    try:
+        while not stop.is_set() and any(threads[t].is_alive() for t in threads):
+            stop.wait(0.25)
+
+            # The parent writes what changed to the fleet store every so often
+            if interval and time.time() >= checkpoint + interval:
+                checkpoint = time.time()
+                save_changed(systems, saves)
+
+            # Only report what changed
+            changes = {}
+            for serial in systems:
+                system = systems[serial]
+                report = (system.status, system.parameter('powered'), system.lasttick())
+                if reported.get(serial) != report:
+                    reported[serial] = changes[serial] = report
+
+            if changes:
+                status.put((shard, changes))
+    except KeyboardInterrupt:
+        pass
+
+    for t in threads:
+        threads[t].stop()
+
+    for t in threads:
+        threads[t].join()
+
+    Manager.power_off(systems)
+    Manager.connection_stats()
+    Logger.flush_all()
+
+    computers = {}
+    for serial in systems:
+        computers[serial] = (str(systems[serial]), json.dumps(systems[serial].summary()))
+
+    # Everything is serialized, nothing reads spilled files anymore
+    FileSystem.close()
+
+    results.put((shard, computers))
+
+
+class ShardPool(threading.Thread):
+    """
+    Splits the fleet across worker processes and aggregates what they report
+    """
+
+    def __init__(self, threadid, name, config, computers, processes):
+        """
+        Initialize the shard pool
+        :param threadid: thread id number
+        :param name: thread name
+        :param config: simulation configuration
+        :param computers: dictionary of serial to serialized system
+        :param processes: how many worker processes to split the fleet across
+        :return:
+        """
+        threading.Thread.__init__(self)
+        self.threadid = threadid
+        self.name = name
+        self.__config = config
+        self.__processes = max(1, min(int(processes), len(computers)))
+        self.__stop = False
+
+        # Deal systems out evenly
+        self.__shards = [[] for _ in range(self.__processes)]
+        for i, serial in enumerate(sorted(computers)):
+            self.__shards[i % self.__processes].append(computers[serial])
+
+        self.statuses = {serial: SystemStatus(serial) for serial in computers}
+        self.results = {}
+
+        # Systems the shards saved at checkpoints which haven't been stored yet
+        self.__saved = {}
+        self.__saved_lock = threading.Lock()
+
+    def stop(self):
+        """
+        Stop every shard
+        :return:
+        """
+        self.__stop = True
+
+    def stopped(self):
+        """
+        Is the pool stopped
+        :return:
+        """
+        return self.__stop
+
+    def collect(self, status, saves):
+        """
+        Apply every status report and keep every checkpoint waiting on the queues
+        :param status: status queue
+        :param saves: checkpoint queue
+        :return:
+        """
+        while True:
+            try:
+                shard, changes = status.get_nowait()
+            except queue.Empty:
+                break
+
+            for serial in changes:
+                self.statuses[serial].update(*changes[serial])
+
+        while True:
+            try:
+                computers = saves.get_nowait()
+            except queue.Empty:
+                break
+
+            with self.__saved_lock:
+                self.__saved.update(computers)
+
+    def saved(self):
+        """
+        Take the systems the shards saved at checkpoints since the last call
+        :return: dictionary of serial to serialized system and module summary
+        """
+        with self.__saved_lock:
+            saved = self.__saved
+            self.__saved = {}
+
+        return saved
+
+    def run(self):
+        """
+        Run the shards until stopped or they all finish
+        :return:
+        """
+        print("Starting", self.__processes, "shards")
+
+        status = multiprocessing.Queue()
+        results = multiprocessing.Queue()
+        stop = multiprocessing.Event()
+        saves = multiprocessing.Queue()
+
+        workers = []
+        for shard, computers in enumerate(self.__shards):
+            worker = multiprocessing.Process(target=shard_worker, name="Shard " + str(shard),
+                                             args=(shard, self.__config, computers, status, results, stop, saves))
+            worker.start()
+            workers.append(worker)
+
+        while not self.stopped() and any(w.is_alive() for w in workers):
+            self.collect(status, saves)
+            time.sleep(0.25)
+
+        stop.set()
+
+        # Results have to be drained before the workers can exit
+        done = set()
+        while len(done) < len(workers):
+            self.collect(status, saves)
+
+            try:
+                shard, systems = results.get(timeout=1)
+            except queue.Empty:
+                if not any(w.is_alive() for w in workers):
+                    break
+                continue
+
+            done.add(shard)
+            self.results.update(systems)
+
+        for worker in workers:
+            worker.join()
+
+        self.collect(status, saves)
+
+        print("Exiting", self.name)
@@ -2,19 +2,22 @@ import threading
 import time
 from tkinter import *
 
+from computer import Clock
+
 
 class GUISim(threading.Thread):
     """
     GUISim is a gui of the simulation of computers
     """
 
-    def __init__(self, threadid, name, systems, ticktime):
+    def __init__(self, threadid, name, systems, ticktime, clock=None):
         """
         Initialize the GUI thread
         :param threadid: thread id
         :param name: thread name
         :param systems: All computers in the simulation
         :param ticktime: How fast should they be ticking
+        :param clock: Clock the systems run on
         :return:
         """
         threading.Thread.__init__(self)
@@ -22,6 +25,7 @@ class GUISim(threading.Thread):
         self.__name = name
         self.__systems = systems
         self.__ticktime = ticktime
+        self.__clock = clock if clock else Clock.wallclock
         self.__stop = False
 
     def stop(self):
@@ -100,7 +104,7 @@ class GUISim(threading.Thread):
                 else:
                     canvas.itemconfig(i[2], fill="black")
 
-                if cutoff < time.time() - i[-1].lasttick():
+                if cutoff < self.__clock.time() - i[-1].lasttick():
                     canvas.itemconfig(i[1], fill="black")
                 else:
                     canvas.itemconfig(i[1], fill="red")
@@ -16,13 +16,28 @@ class Configurator:
         else:
             self.__config = {
               "store": "computers",
+              "store_backend": "files",
+              "checkpoint": None,
               "pool": "component_pool",
+              "pool_cache": None,
+              "fs_budget": None,
+              "fs_spill": None,
+              "sql_connections": 128,
+              "sql_write_behind": False,
+              "sql_cached_statements": 128,
               "system_count": 5,
               "setup": 1,
               "simulation": True,
               "gui": True,
               "inv_path": "invconfig.json",
-              "tickrate": 0.3
+              "tickrate": 0.3,
+              "scheduler": "thread",
+              "workers": 1,
+              "inflight": 100,
+              "processes": 1,
+              "generate_processes": 1,
+              "clock": "wall",
+              "duration": None
             }
 
     def config_file(self, fp):
@@ -41,6 +56,15 @@ class Configurator:
         """
         return self.__config[item]
 
+    def get(self, item, default=None):
+        """
+        Get configuration item, falling back to a default for optional settings
+        :param item: configuration item
+        :param default: value returned if the item isn't configured
+        :return:
+        """
+        return self.__config.get(item, default)
+
     def __setitem__(self, key, value):
         """
         Set configuration value using [] syntax
@@ -0,0 +1,133 @@
+import asyncio
+import time
+
+
+class Clock:
+    """
+    Wall clock, simulated delays really block the calling thread
+    """
+
+    virtual = False
+
+    def time(self):
+        """
+        Current time
+        :return:
+        """
+        return time.time()
+
+    def sleep(self, seconds):
+        """
+        Block for a simulated delay
+        :param seconds: length of the delay
+        :return:
+        """
+        time.sleep(seconds)
+
+    async def sleep_async(self, seconds):
+        """
+        Simulated delay which only suspends the calling coroutine
+        :param seconds: length of the delay
+        :return:
+        """
+        await asyncio.sleep(seconds)
+
+    def resume(self, busy):
+        """
+        When a system that was busy for a while is free again, the wall clock already slept through it
+        :param busy: seconds of delay the system accumulated
+        :return:
+        """
+        return self.time()
+
+    def advance(self, to):
+        """
+        Move the clock forward, the wall clock moves on its own
+        :param to: time to move to
+        :return:
+        """
+        pass
+
+
+class EventClock(Clock):
+    """
+    Wall clock of an event loop, delays never block the loop, they're charged to the system which is
+        only due again once they're over
+    """
+
+    def sleep(self, seconds):
+        """
+        Delays are charged to the system by the scheduler instead of blocking
+        :param seconds: length of the delay
+        :return:
+        """
+        pass
+
+    def resume(self, busy):
+        """
+        When a system that was busy for a while is free again
+        :param busy: seconds of delay the system accumulated
+        :return:
+        """
+        return self.time() + busy
+
+
+class VirtualClock(Clock):
+    """
+    Discrete event clock, delays never block and time only moves when the scheduler fast-forwards it
+        to the next event
+    """
+
+    virtual = True
+
+    def __init__(self, start=None):
+        """
+        Initialize the clock
+        :param start: virtual time to start at, defaults to now
+        :return:
+        """
+        self.__now = time.time() if start is None else start
+
+    def time(self):
+        """
+        Current virtual time
+        :return:
+        """
+        return self.__now
+
+    def sleep(self, seconds):
+        """
+        Delays are charged to the system by the scheduler instead of blocking
+        :param seconds: length of the delay
+        :return:
+        """
+        pass
+
+    async def sleep_async(self, seconds):
+        """
+        Delays are charged to the system by the scheduler instead of suspending
+        :param seconds: length of the delay
+        :return:
+        """
+        pass
+
+    def resume(self, busy):
+        """
+        When a system that was busy for a while is free again
+        :param busy: seconds of delay the system accumulated
+        :return:
+        """
+        return self.__now + busy
+
+    def advance(self, to):
+        """
+        Fast-forward the clock, time never moves backwards
+        :param to: time to move to
+        :return:
+        """
+        if to > self.__now:
+            self.__now = to
+
+
+wallclock = Clock()
+eventclock = EventClock()
@@ -1,12 +1,91 @@
+import json
+import math
 import random
 import string
+import types
+import weakref
 
 
 class BaseComponent:
+    __slots__ = ()
+
     def __init__(self):
         pass
 
 
+class Template(dict):
+    """
+    Attributes shared by every component equal to them, never changed once made
+    """
+
+    __slots__ = ('__weakref__',)
+
+
+# Read-only component templates shared by every computer, keyed by their json, gone once no component uses them
+templates = weakref.WeakValueDictionary()
+
+# Placeholder for attributes a component doesn't have at all
+missing = object()
+
+# Attributes every component keeps to itself
+own = ('cid', 'serial')
+
+
+def template_key(block):
+    """
+    Key of the template of a component
+    :param block: component attributes
+    :return:
+    """
+    return json.dumps({k: v for k, v in block.items() if k not in own}, sort_keys=True)
+
+
+def template(block, key=None):
+    """
+    Get the shared template equal to the block, a copy of the block becomes the template if there is none yet
+    :param block: component attributes
+    :param key: template_key of the block, worked out when not given
+    :return:
+    """
+    if key is None:
+        key = template_key(block)
+
+    shared = templates.get(key, None)
+    if shared is None:
+        # Our own copy, the caller's can't change it behind every component's back
+        shared = templates[key] = Template((k, clone(v)) for k, v in block.items() if k not in own)
+
+    return shared
+
+
+def clone(block):
+    """
+    Copy a decoded json structure, a lot cheaper than copy.deepcopy, read-only views become plain again
+    :param block: json data
+    :return:
+    """
+    if isinstance(block, (dict, types.MappingProxyType)):
+        return {k: clone(v) for k, v in block.items()}
+    elif isinstance(block, (list, tuple)):
+        return [clone(v) for v in block]
+
+    return block
+
+
+def freeze(block):
+    """
+    Read-only view of a decoded json structure, dictionaries become mapping proxies and lists tuples
+    :param block: json data
+    :return:
+    """
+    if isinstance(block, dict):
+        return types.MappingProxyType({k: freeze(v) for k, v in block.items()})
+    elif isinstance(block, list):
+        return tuple(freeze(v) for v in block)
+
+    return block
+
+
 def string_generator(length):
     """
     Generate a random string of numbers and letters of length
@@ -16,36 +95,177 @@ def string_generator(length):
     return ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(length))
 
 
+class SerialsExhausted(Exception): pass
+
+
+class SerialAllocator:
+    """
+    Hands out unique serials of a fixed length
+
+    A counter is walked through a permutation of every possible serial, so serials never repeat and
+        disjoint counter ranges can be handed to different processes without them ever colliding
+    """
+
+    alphabet = string.ascii_uppercase + string.digits
+
+    def __init__(self, length, start=0, stop=None, offset=None, taken=None):
+        """
+        Initialize the allocator
+        :param length: length of the serials
+        :param start: first counter value
+        :param stop: counter value to stop at, defaults to every possible serial
+        :param offset: where the permutation starts, allocators that share a counter range must share it
+        :param taken: set of serials which are already in use and have to be skipped
+        :return:
+        """
+        self.__length = length
+        self.__space = len(self.alphabet) ** length
+        self.__counter = start
+        self.__stop = self.__space if stop is None else min(stop, self.__space)
+        self.__offset = random.randrange(self.__space) if offset is None else offset
+        self.__taken = taken if taken is not None else set()
+
+        # Any step sharing no factor with the space visits every serial exactly once
+        self.__step = 2654435761 % self.__space
+        while math.gcd(self.__step, self.__space) != 1:
+            self.__step += 1
+
+    @property
+    def offset(self):
+        """
+        Where the permutation starts
+        :return:
+        """
+        return self.__offset
+
+    def encode(self, index):
+        """
+        Turn a number into a serial
+        :param index: number below the size of the serial space
+        :return:
+        """
+        chars = []
+        for _ in range(self.__length):
+            index, rem = divmod(index, len(self.alphabet))
+            chars.append(self.alphabet[rem])
+
+        return ''.join(chars)
+
+    def next(self):
+        """
+        Get the next unused serial
+        :return:
+        """
+        while self.__counter < self.__stop:
+            serial = self.encode((self.__counter * self.__step + self.__offset) % self.__space)
+            self.__counter += 1
+
+            if serial not in self.__taken:
+                return serial
+
+        raise SerialsExhausted
+
+    def reserve(self, count):
+        """
+        Set aside a range of the counter, to be handed to another allocator with the same offset
+        :param count: how many serials to set aside
+        :return: start and stop of the range
+        """
+        start = self.__counter
+        self.__counter = min(start + count, self.__stop)
+
+        return start, self.__counter
+
+    def batch(self, count):
+        """
+        Get a batch of unused serials
+        :param count: how many serials
+        :return:
+        """
+        return [self.next() for _ in range(count)]
+
+
 class Component(BaseComponent):
     """
     Simulated hardware components
+
+    Most computers draw identical components from the pool, so the attributes live in a shared
+        read-only template and each component only keeps what is its own. Nested values are handed
+        out read-only, every change goes through [] so it's versioned and saved
     """
 
-    def __init__(self, component):
+    __slots__ = ('__template', '__cid', '__serial', '__overrides', '__version')
+
+    def __init__(self, component, key=None):
         """
         Initialize the component
         :param component: component to create
+        :param key: template_key of the component, if known
         :return:
         """
         super().__init__()
-        self.__component = component
-        if not self.__component.get('cid', None):
-            self.__component['cid'] = string_generator(3)
+        self.__version = 0
+        self.split(component, key)
+
+        if not self.__cid:
+            self.__cid = string_generator(3)
+
+    def split(self, component, key=None):
+        """
+        Split the component into the shared template and its own attributes
+        :param component: component attributes
+        :param key: template_key of the component, if known
+        :return:
+        """
+        self.__template = template(component, key)
+        self.__cid = component.get('cid', None)
+        self.__serial = component.get('serial', missing)
+        self.__overrides = None
 
     def __str__(self):
         """
         Stringified version of the module
         :return:
         """
-        return str(self.__component)
+        return str(self.attributes())
+
+    def __reduce__(self):
+        """
+        Pickle as plain attributes, the template gets shared again when unpickled
+        :return:
+        """
+        return self.__class__, (self.attributes(),)
+
+    @property
+    def version(self):
+        """
+        Incremented every time the component changes
+        :return:
+        """
+        return self.__version
 
     @property
     def component(self):
         """
-        Return the component itself
+        Return a read-only view of the attributes of the component, change them with [] or by setting
+            the whole component
         :return:
         """
-        return self.__component
+        return freeze(self.attributes())
+
+    def attributes(self):
+        """
+        Plain dictionary of the attributes of the component, for reading only as nested values are
+            shared with the template
+        :return:
+        """
+        component = dict(self.__template)
+        component['cid'] = self.__cid
+        if self.__serial is not missing:
+            component['serial'] = self.__serial
+        if self.__overrides:
+            component.update(self.__overrides)
+        return component
 
     @component.setter
     def component(self, value):
@@ -54,7 +274,8 @@ class Component(BaseComponent):
         :param value:
         :return:
         """
-        self.__component = value
+        self.split(value)
+        self.__version += 1
 
     def __getitem__(self, item):
         """
@@ -62,7 +283,21 @@ class Component(BaseComponent):
         :param item: attribute name
         :return:
         """
-        return self.__component.get(item, None)
+        if item == 'cid':
+            return self.__cid
+        elif item == 'serial':
+            return None if self.__serial is missing else self.__serial
+
+        if self.__overrides and item in self.__overrides:
+            value = self.__overrides[item]
+        else:
+            value = self.__template.get(item, None)
+
+        # Changed in place it would never be saved, nested values are read-only
+        if isinstance(value, (dict, list)):
+            return freeze(value)
+
+        return value
 
     def __setitem__(self, key, value):
         """
@@ -71,7 +306,25 @@ class Component(BaseComponent):
         :param value: new attribute value
         :return:
         """
-        self.__component[key] = value
+        if key == 'cid':
+            self.__cid = value
+        elif key == 'serial':
+            self.__serial = value
+        else:
+            # Our own copy, the caller's can't change it behind our back
+            self.__own()[key] = clone(value)
+
+        self.__version += 1
+
+    def __own(self):
+        """
+        Attributes this component changed from its template, only made once something changes
+        :return:
+        """
+        if self.__overrides is None:
+            self.__overrides = {}
+
+        return self.__overrides
 
 
 class Modules(BaseComponent):
@@ -86,6 +339,11 @@ class Modules(BaseComponent):
         """
         super().__init__()
         self.__components = {}
+        self.__version = 0
+
+        # Json of every module and the version it was encoded at
+        self.__encoded = None
+        self.__encoded_version = None
 
     def __str__(self):
         """
@@ -94,6 +352,22 @@ class Modules(BaseComponent):
         """
         return str(self.get_all())
 
+    @property
+    def version(self):
+        """
+        Incremented every time a component is added or changed
+        :return:
+        """
+        return self.__version + sum(j.version for i in self.__components.values() for j in i)
+
+    @property
+    def cids(self):
+        """
+        Set of every cid in use by the components
+        :return:
+        """
+        return {j['cid'] for i in self.__components.values() for j in i}
+
     @property
     def module(self):
         """
@@ -102,6 +376,18 @@ class Modules(BaseComponent):
         """
         return self.__components
 
+    def encode(self):
+        """
+        Json of all modules and components, only encoded again once something changed
+        :return:
+        """
+        version = self.version
+        if self.__encoded_version != version:
+            self.__encoded = json.dumps(self.get_all())
+            self.__encoded_version = version
+
+        return self.__encoded
+
     def get_all(self):
         """
         Build a dictionary of all modules and components
@@ -113,7 +399,7 @@ class Modules(BaseComponent):
             lst = []
             # Break down the list and append components to master list
             for j in self.__components[i]:
-                lst.append(j.component)
+                lst.append(j.attributes())
 
             arr[i] = lst
 
@@ -138,6 +424,7 @@ class Modules(BaseComponent):
             self.__components[key] = []
 
         self.__components[key].append(value)
+        self.__version += 1
 
     def keys(self):
         """
@@ -1,3 +1,10 @@
+import bisect
+import collections
+import mmap
+import tempfile
+import threading
+import types
+import weakref
 from json import dumps
 
 
@@ -5,9 +12,393 @@ class FileExists(Exception): pass
 class FileDoesNotExist(Exception): pass
 
 
+class AppendFile:
+    """
+    File which is mostly appended to, like a log
+
+    Appends are kept as a list of chunks and only joined when the file is read, so appending never
+        copies what is already in the file
+    """
+
+    def __init__(self, data='', maxsize=None, rotate=0):
+        """
+        Initialize the file
+        :param data: initial content
+        :param maxsize: size the file is rotated at, None for no limit
+        :param rotate: how many rotated copies are kept
+        :return:
+        """
+        self.__chunks = [data] if data else []
+        self.__size = len(data)
+        self.maxsize = maxsize
+        self.rotate = rotate
+
+    def __str__(self):
+        """
+        Content of the file
+        :return:
+        """
+        if len(self.__chunks) > 1:
+            self.__chunks = [''.join(self.__chunks)]
+
+        return self.__chunks[0] if self.__chunks else ''
+
+    def __len__(self):
+        """
+        Size of the file
+        :return:
+        """
+        return self.__size
+
+    def append(self, data):
+        """
+        Append to the file
+        :param data: data to append
+        :return:
+        """
+        self.__chunks.append(data)
+        self.__size += len(data)
+
+    def full(self):
+        """
+        Has the file grown past its size limit
+        :return:
+        """
+        return self.maxsize is not None and self.__size > self.maxsize
+
+
+class SpillStore:
+    """
+    File cold files are spilled to, read back through mmap
+
+    Space of files which are read back or removed is reused by later spills, so the file only grows
+        as large as what is spilled at once. The file is anonymous so it disappears with the process
+    """
+
+    def __init__(self, path=None):
+        """
+        Create the spill file
+        :param path: folder to create it in, defaults to the system temp folder
+        :return:
+        """
+        self.__file = tempfile.TemporaryFile(dir=path)
+        self.__size = 0
+        self.__map = None
+        self.__lock = threading.Lock()
+
+        # Free extents as offset and length pairs, sorted by offset and never adjacent
+        self.__free = []
+
+    @property
+    def size(self):
+        """
+        How far into the file anything is spilled
+        :return:
+        """
+        return self.__size
+
+    @property
+    def dead(self):
+        """
+        Bytes of free extents waiting to be reused
+        :return:
+        """
+        return sum(length for _, length in self.__free)
+
+    def write(self, data):
+        """
+        Spill data
+        :param data: string to spill
+        :return: offset and length of the spilled data
+        """
+        raw = data.encode('utf-8')
+
+        with self.__lock:
+            offset = self.allocate(len(raw))
+            self.__file.seek(offset)
+            self.__file.write(raw)
+
+            # The mapping may already cover reused space, it has to see the new data
+            self.__file.flush()
+
+        return offset, len(raw)
+
+    def allocate(self, length):
+        """
+        Find room for data, the first free extent it fits in or the end of the file, the caller holds the lock
+        :param length: length of the data in bytes
+        :return: offset
+        """
+        for i, (offset, size) in enumerate(self.__free):
+            if size >= length:
+                if size == length:
+                    del self.__free[i]
+                else:
+                    self.__free[i] = (offset + length, size - length)
+                return offset
+
+        offset = self.__size
+        self.__size += length
+        return offset
+
+    def free(self, offset, length):
+        """
+        Data is no longer needed, its space is reused
+        :param offset: where the data starts
+        :param length: length of the data in bytes
+        :return:
+        """
+        if not length:
+            return
+
+        with self.__lock:
+            i = bisect.bisect(self.__free, (offset, length))
+
+            # Merge with the neighbouring free extents
+            if i < len(self.__free) and offset + length == self.__free[i][0]:
+                length += self.__free.pop(i)[1]
+            if i and self.__free[i - 1][0] + self.__free[i - 1][1] == offset:
+                i -= 1
+                offset, previous = self.__free.pop(i)
+                length += previous
+
+            # Free space at the end just shrinks the file
+            if offset + length == self.__size:
+                self.__size = offset
+            else:
+                self.__free.insert(i, (offset, length))
+
+    def read(self, offset, length):
+        """
+        Read spilled data back
+        :param offset: where the data starts
+        :param length: length of the data in bytes
+        :return: string
+        """
+        if not length:
+            return ''
+
+        with self.__lock:
+            # Map the file again once it has grown past what is mapped
+            if self.__map is None or len(self.__map) < offset + length:
+                self.__file.flush()
+                if self.__map is not None:
+                    self.__map.close()
+                self.__map = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+
+            return self.__map[offset:offset + length].decode('utf-8')
+
+    def close(self):
+        """
+        Close and remove the spill file
+        :return:
+        """
+        with self.__lock:
+            if self.__map is not None:
+                self.__map.close()
+                self.__map = None
+            self.__file.close()
+
+
+class SpilledFile:
+    """
+    A file that only lives in the spill store
+    """
+
+    __slots__ = ('store', 'offset', 'length', 'maxsize', 'rotate', 'append')
+
+    def __init__(self, store, file):
+        """
+        Spill a file
+        :param store: SpillStore
+        :param file: string or AppendFile
+        :return:
+        """
+        self.store = store
+        self.offset, self.length = store.write(str(file))
+
+        # Append files come back with their limits
+        self.append = isinstance(file, AppendFile)
+        self.maxsize = file.maxsize if self.append else None
+        self.rotate = file.rotate if self.append else 0
+
+    def __str__(self):
+        """
+        Content of the file
+        :return:
+        """
+        return self.store.read(self.offset, self.length)
+
+    def load(self):
+        """
+        Read the file back as it was before it was spilled
+        :return:
+        """
+        if self.append:
+            return AppendFile(str(self), self.maxsize, self.rotate)
+
+        return str(self)
+
+    def free(self):
+        """
+        The file is back in memory or gone, its space in the store is reused
+        :return:
+        """
+        self.store.free(self.offset, self.length)
+        self.length = 0
+
+
+class FileBudget:
+    """
+    Fleet-wide memory budget for files
+
+    Every file in memory is tracked least recently used first, once they take up more than the
+        budget the coldest files are spilled to disk until everything fits again
+    """
+
+    def __init__(self, limit, path=None):
+        """
+        Initialize the budget
+        :param limit: how many characters of files are kept in memory
+        :param path: folder the spill file is created in
+        :return:
+        """
+        self.limit = limit
+        self.store = SpillStore(path)
+        self.__files = collections.OrderedDict()
+        self.__size = 0
+        self.__lock = threading.Lock()
+
+    @property
+    def size(self):
+        """
+        How much the files in memory take up
+        :return:
+        """
+        return self.__size
+
+    def account(self, fs, name, size, touch=True):
+        """
+        Track a file in memory, spilling the coldest files if the budget is exceeded
+        :param fs: FileSystem the file is in
+        :param name: filename
+        :param size: size of the file
+        :param touch: mark the file as most recently used
+        :return:
+        """
+        key = (id(fs), name)
+        victims = []
+
+        with self.__lock:
+            old = self.__files.get(key, None)
+            if old is not None:
+                self.__size -= old[2]
+
+            self.__files[key] = (weakref.ref(fs), name, size)
+            self.__size += size
+
+            if touch:
+                self.__files.move_to_end(key)
+
+            while self.__size > self.limit and self.__files:
+                _, victim = self.__files.popitem(last=False)
+                self.__size -= victim[2]
+                victims.append(victim)
+
+        # Spilling takes the filesystem's lock, never while holding ours
+        for ref, victim, size in victims:
+            owner = ref()
+            if owner is not None and not owner.spill(victim):
+                # Busy files are in use, track them as recently used instead
+                with self.__lock:
+                    key = (id(owner), victim)
+                    if key not in self.__files:
+                        self.__files[key] = (ref, victim, size)
+                        self.__size += size
+
+    def touch(self, fs, name):
+        """
+        Mark a file as most recently used
+        :param fs: FileSystem the file is in
+        :param name: filename
+        :return:
+        """
+        with self.__lock:
+            if (id(fs), name) in self.__files:
+                self.__files.move_to_end((id(fs), name))
+
+    def forget(self, fs, name):
+        """
+        Stop tracking a file
+        :param fs: FileSystem the file was in
+        :param name: filename
+        :return:
+        """
+        with self.__lock:
+            old = self.__files.pop((id(fs), name), None)
+            if old is not None:
+                self.__size -= old[2]
+
+    def close(self):
+        """
+        Remove the spill file
+        :return:
+        """
+        self.store.close()
+
+
+# Fleet-wide file budget, None keeps every file in memory
+budget = None
+
+
+def limit(size, path=None):
+    """
+    Put every filesystem in this process under a memory budget
+    :param size: how many characters of files are kept in memory, None for no limit
+    :param path: folder cold files are spilled to, defaults to the system temp folder
+    :return:
+    """
+    global budget
+
+    # Files already spilled keep their own reference to the old store
+    budget = FileBudget(size, path) if size is not None else None
+
+
+def close():
+    """
+    Remove the spill file of the budget, only once nothing reads the files of this process anymore
+    :return:
+    """
+    global budget
+
+    if budget is not None:
+        budget.close()
+        budget = None
+
+
+# Read-only files every filesystem in this process starts out with
+shared = types.MappingProxyType({})
+
+
+def share(files):
+    """
+    Set the read-only base layer of filesystems created from now on
+    :param files: dictionary of filename to content
+    :return:
+    """
+    global shared
+
+    shared = types.MappingProxyType(dict(files))
+
+
 class FileSystem:
     """
     Virtual filesystem
+
+    Files shared by the whole fleet sit in a read-only base layer, every filesystem only keeps the
+        files it added or changed and whiteouts for the base files it deleted
+
+    Under a fleet-wide budget, cold files are spilled to disk and read back when they're used again
     """
 
     def __init__(self):
@@ -15,29 +406,212 @@ class FileSystem:
         Initialize the file storage
         :return:
         """
+        self.__base = shared
         self.__data = {}
+        self.__whiteouts = set()
+        self.__version = 0
+        self.__lock = threading.RLock()
+
+        # Json of each file, dropped whenever the file changes
+        self.__encoded = {}
 
     def __str__(self):
         """
         Return the json encoded string of the filestore
         :return:
         """
-        return dumps(self.__data)
+        return self.encode()
+
+    def __getstate__(self):
+        """
+        Pickle the overlay, locks and the base layer belong to the process
+        :return:
+        """
+        state = self.__dict__.copy()
+        state['_FileSystem__data'] = {k: v.load() if isinstance(v, SpilledFile) else v for k, v in self.__data.items()}
+        del state['_FileSystem__lock']
+        del state['_FileSystem__base']
+        return state
+
+    def __setstate__(self, state):
+        """
+        Unpickle onto the base layer of this process
+        :param state: pickled state
+        :return:
+        """
+        self.__dict__.update(state)
+        self.__lock = threading.RLock()
+        self.__base = shared
+
+    def encode(self):
+        """
+        Json of the files in the overlay, only the files that changed since the last call are encoded again
+        :return:
+        """
+        parts = []
+        cached = []
+        for name in list(self.__data):
+            # A change landing between reading the file and caching its json would be lost
+            with self.__lock:
+                part = self.__encoded.get(name, None)
+                if part is None:
+                    file = self.__data.get(name, None)
+                    if file is None:
+                        continue
+
+                    part = dumps(name) + ': ' + dumps(file if isinstance(file, str) else str(file))
+
+                    # Spilled files are read back for saving, but shouldn't end up in memory again
+                    if not isinstance(file, SpilledFile):
+                        self.__encoded[name] = part
+                        cached.append((name, len(file) + len(part)))
+
+            parts.append(part)
+
+        # Never accounted for while holding our lock
+        if budget:
+            for name, size in cached:
+                budget.account(self, name, size, False)
+
+        return '{' + ', '.join(parts) + '}'
+
+    def changed(self, name):
+        """
+        A file changed
+        :param name: filename
+        :return:
+        """
+        self.__encoded.pop(name, None)
+        self.__version += 1
+
+    def store(self, name, file):
+        """
+        Put a file in the store
+        :param name: filename
+        :param file: string or AppendFile
+        :return:
+        """
+        with self.__lock:
+            self.replace(name, file)
+            self.__whiteouts.discard(name)
+            self.changed(name)
+
+        if budget:
+            budget.account(self, name, len(file))
+
+    def replace(self, name, file):
+        """
+        Put a file in the overlay, the caller holds the lock, the space of a spilled file it replaces is reused
+        :param name: filename
+        :param file: string or AppendFile
+        :return:
+        """
+        old = self.__data.get(name, None)
+        if isinstance(old, SpilledFile):
+            old.free()
+
+        self.__data[name] = file
+
+    def spill(self, name):
+        """
+        Move a file out of memory into the spill store, the content doesn't change
+        :param name: filename
+        :return: False if the filesystem is busy and the file stays in memory
+        """
+        # Whoever holds the lock is using the file right now, it isn't cold
+        if not self.__lock.acquire(blocking=False):
+            return False
+
+        try:
+            file = self.__data.get(name, None)
+            if file is not None and not isinstance(file, SpilledFile):
+                self.__data[name] = SpilledFile(budget.store, file)
+                self.__encoded.pop(name, None)
+        finally:
+            self.__lock.release()
+
+        return True
+
+    def take(self, name):
+        """
+        Get a file, reading it back into memory if it was spilled, the caller holds the lock and
+            accounts for it afterwards
+        :param name: filename
+        :return: string or AppendFile and whether it was read back
+        """
+        if name not in self.__data:
+            return self.__base[name], False
+
+        file = self.__data[name]
+        if isinstance(file, SpilledFile):
+            self.replace(name, file.load())
+            return self.__data[name], True
+
+        return file, False
+
+    def load(self, name):
+        """
+        Get a file, reading it back into memory if it was spilled
+        :param name: filename
+        :return: string or AppendFile
+        """
+        with self.__lock:
+            file, loaded = self.take(name)
+
+        if budget:
+            if loaded:
+                budget.account(self, name, len(file))
+            else:
+                budget.touch(self, name)
+
+        return file
+
+    @property
+    def version(self):
+        """
+        Incremented every time a file changes
+        :return:
+        """
+        return self.__version
 
     def get(self):
         """
-        Return the actual datastore
+        Return the actual datastore, only what is in the overlay
         :return:
         """
         return self.__data
 
+    @property
+    def whiteouts(self):
+        """
+        Base files deleted from this filesystem
+        :return:
+        """
+        return sorted(self.__whiteouts)
+
+    def restore(self, files, whiteouts=()):
+        """
+        Load a saved overlay, files identical to the base layer are shared instead of kept
+        :param files: dictionary of filename to content
+        :param whiteouts: base files that were deleted
+        :return:
+        """
+        for name in files:
+            if self.__base.get(name, None) != files[name]:
+                self.store(name, files[name])
+
+        for name in whiteouts:
+            if name in self.__base:
+                self.__whiteouts.add(name)
+                self.changed(name)
+
     def fileexists(self, name):
         """
         Check whether a file exists on the system
         :param name: filenam
         :return: boolean
         """
-        return name in self.__data
+        return name in self.__data or (name in self.__base and name not in self.__whiteouts)
 
     def appendfile(self, name, data):
         """
@@ -49,9 +623,86 @@ class FileSystem:
         if not self.fileexists(name):
             return None
 
-        self.__data[name] += data
+        with self.__lock:
+            # Base files are copied up into the overlay
+            file, _ = self.take(name)
+            if not isinstance(file, AppendFile):
+                file = self.__data[name] = AppendFile(file)
+
+            file.append(data)
+            self.changed(name)
+
+        if file.full():
+            self.rotate(name)
+        elif budget:
+            budget.account(self, name, len(file))
+
         return True
 
+    def appendable(self, name, maxsize=None, rotate=0):
+        """
+        Make sure a file exists and is cheap to append to, keeping what is already in it
+        :param name: filename
+        :param maxsize: size the file is rotated at, None for no limit
+        :param rotate: how many rotated copies are kept
+        :return:
+        """
+        if not self.fileexists(name):
+            self.addfile(name, AppendFile())
+
+        with self.__lock:
+            file, _ = self.take(name)
+            if not isinstance(file, AppendFile):
+                # Same content, nothing changed unless it's copied up from the base
+                copied = name not in self.__data
+                file = self.__data[name] = AppendFile(file)
+                if copied:
+                    self.changed(name)
+
+            file.maxsize = maxsize
+            file.rotate = rotate
+
+        if file.full():
+            self.rotate(name)
+        elif budget:
+            budget.account(self, name, len(file))
+
+    def rotate(self, name):
+        """
+        Rotate an append file, name.1 is the most recent copy and anything past its rotate count is dropped
+        :param name: filename
+        :return:
+        """
+        moved = []
+
+        with self.__lock:
+            file, _ = self.take(name)
+
+            # Shift the rotated copies along, the oldest one falls off
+            for i in range(file.rotate, 1, -1):
+                older = name + '.' + str(i - 1)
+                if older in self.__data:
+                    self.replace(name + '.' + str(i), self.take(older)[0])
+                    self.__data.pop(older)
+                    self.changed(name + '.' + str(i))
+                    self.changed(older)
+                    moved.append(name + '.' + str(i))
+
+            if file.rotate:
+                self.replace(name + '.1', str(file))
+                self.changed(name + '.1')
+                moved.append(name + '.1')
+
+            self.__data[name] = AppendFile('', file.maxsize, file.rotate)
+            self.changed(name)
+            moved.append(name)
+
+        if budget:
+            for i in moved:
+                file = self.__data.get(i, None)
+                if file is not None and not isinstance(file, SpilledFile):
+                    budget.account(self, i, len(file))
+
     def addfile(self, name, data):
         """
         Add the file to the file store
@@ -62,9 +713,9 @@ class FileSystem:
         if self.fileexists(name):
             raise FileExists
 
-        self.__data[name] = data
+        self.store(name, data)
 
-        return self.__data[name]
+        return data
 
     def getfile(self, name):
         """
@@ -75,7 +726,28 @@ class FileSystem:
         if not self.fileexists(name):
             return None
 
-        return self.__data[name]
+        file = self.load(name)
+        return str(file) if isinstance(file, AppendFile) else file
+
+    def drop(self, name):
+        """
+        Remove a file from the store
+        :param name: filename
+        :return:
+        """
+        with self.__lock:
+            file = self.__data.pop(name, None)
+            if isinstance(file, SpilledFile):
+                file.free()
+
+            # Base files can't be removed, they're hidden instead
+            if name in self.__base:
+                self.__whiteouts.add(name)
+
+            self.changed(name)
+
+        if budget:
+            budget.forget(self, name)
 
     def delfile(self, name):
         """
@@ -86,7 +758,7 @@ class FileSystem:
         if not self.fileexists(name):
             raise FileDoesNotExist
 
-        self.__data.pop(name, None)
+        self.drop(name)
         return True
 
     def __getitem__(self, item):
@@ -95,7 +767,10 @@ class FileSystem:
         :param item: attribute name
         :return:
         """
-        return self.__data[item]
+        if not self.fileexists(item):
+            raise KeyError(item)
+
+        return self.getfile(item)
 
     def __setitem__(self, key, value):
         """
@@ -104,4 +779,4 @@ class FileSystem:
         :param value: new attribute value
         :return:
         """
-        self.__data[key] = value
+        self.store(key, value)
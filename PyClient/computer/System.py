@@ -1,6 +1,7 @@
 import json
 import time
 
+from . import Clock
 from . import Component
 from . import FileSystem
 
@@ -15,15 +16,17 @@ class System:
 
     def __str__(self):
         """
-        Json/String version of the object
+        Json/String version of the object, the same as json.dumps of the modules and filesystem but
+            only the sections which changed since the last call get encoded again
         :return:
         """
-        computron = {
-            'modules': self.__modules.get_all(),
-            'filesystem': self.__filesystem.get()
-        }
+        computron = '{"modules": ' + self.__modules.encode() + ', "filesystem": ' + self.__filesystem.encode()
+
+        # Deleted shared files, only there when there are any
+        if self.__filesystem.whiteouts:
+            computron += ', "whiteouts": ' + json.dumps(self.__filesystem.whiteouts)
 
-        return json.dumps(computron)
+        return computron + '}'
 
     def __init__(self):
         """
@@ -31,9 +34,12 @@ class System:
         :return:
         """
         self.__modules = Component.Modules()
+        self.__cids = None
         self.__lasttick = None
         self.__status = 'Off'
         self.__systime = time.time()
+        self.__clock = Clock.wallclock
+        self.__busy = 0
 
         self.__params = {
             "powered": False
@@ -43,6 +49,76 @@ class System:
         self.__software = []
         self.__filesystem = FileSystem.FileSystem()
 
+        # Version last saved, None when never saved
+        self.__saved = None
+
+    def version(self):
+        """
+        Version of everything that gets saved, changes whenever a component or file changes
+        :return:
+        """
+        return self.__modules.version, self.__filesystem.version
+
+    @property
+    def dirty(self):
+        """
+        Has the system changed since it was last saved
+        :return:
+        """
+        return self.__saved != self.version()
+
+    def clean(self, version=None):
+        """
+        Mark the system as saved
+        :param version: version that was saved, defaults to the current one
+        :return:
+        """
+        self.__saved = self.version() if version is None else version
+
+    @property
+    def clock(self):
+        """
+        Clock the system runs on
+        :return:
+        """
+        return self.__clock
+
+    @clock.setter
+    def clock(self, clock):
+        """
+        Set the clock the system runs on
+        :param clock: Clock instance
+        :return:
+        """
+        self.__clock = clock
+
+    def wait(self, seconds):
+        """
+        Simulated delay, blocks on a wall clock and is charged to the system on a virtual one
+        :param seconds: length of the delay
+        :return:
+        """
+        self.__busy += seconds
+        self.__clock.sleep(seconds)
+
+    async def wait_async(self, seconds):
+        """
+        Simulated delay which only suspends the calling coroutine
+        :param seconds: length of the delay
+        :return:
+        """
+        self.__busy += seconds
+        await self.__clock.sleep_async(seconds)
+
+    def busy(self):
+        """
+        How long the system was delayed since the last call
+        :return:
+        """
+        busy = self.__busy
+        self.__busy = 0
+        return busy
+
     @property
     def status(self):
         """
@@ -72,6 +148,15 @@ class System:
 
         self.__filesystem.addfile(filename, data)
 
+    def restore_files(self, files, whiteouts=()):
+        """
+        Load the saved files of the computer on top of the shared ones
+        :param files: dictionary of filename to data
+        :param whiteouts: shared files which were deleted
+        :return:
+        """
+        self.__filesystem.restore(files, whiteouts)
+
     def readfile(self, filename):
         """
         Read the file from the filestorage
@@ -96,14 +181,36 @@ class System:
         """
         return self.__modules
 
-    def add_component(self, name, component):
+    def encode_modules(self):
+        """
+        Json of every module and component
+        :return:
+        """
+        return self.__modules.encode()
+
+    def summary(self):
+        """
+        How many components each module has
+        :return:
+        """
+        return {i: len(self.__modules[i]) for i in self.__modules.keys()}
+
+    def add_component(self, name, component, key=None):
         """
         Add a component to the system
         :param name: module name
         :param component: component
+        :param key: template_key of the component, if known
         :return:
         """
-        self.__modules[name] = Component.Component(component)
+        # Hand out cids which are unique within this computer
+        if not component.get('cid', None):
+            if not self.__cids:
+                self.__cids = Component.SerialAllocator(3, taken=self.__modules.cids)
+
+            component['cid'] = self.__cids.next()
+
+        self.__modules[name] = Component.Component(component, key)
 
     def get_component(self, name=None):
         """
@@ -157,12 +264,9 @@ class System:
         """
         return self.__params[key]
 
-    def tick(self, tmr):
+    def delta(self, tmr):
         """
-        Simulation tick
-
-        This handles multiple simulation cases such as updating hardware, interface with SQLite
-            and interact with the API
+        Record the tick and return the time since the last one
         :param tmr: time of tick
         :return:
         """
@@ -174,6 +278,19 @@ class System:
 
         self.__lasttick = tmr
 
+        return dtime
+
+    def tick(self, tmr):
+        """
+        Simulation tick
+
+        This handles multiple simulation cases such as updating hardware, interface with SQLite
+            and interact with the API
+        :param tmr: time of tick
+        :return:
+        """
+        dtime = self.delta(tmr)
+
         # Don't process unless system in on
         if not self.parameter('powered'):
             return
@@ -183,13 +300,40 @@ class System:
         # For all programs in system
         for i, program in enumerate(self.__software):
             self.status = 'Tick ' + program.__class__.__name__
-            time.sleep(0.1)
+            self.wait(0.1)
 
             # Tick them
             if not program.tick(tmr, dtime):
                 self.__software.pop(i)
                 self.status = program.__class__.__name__+' crashed'
-                time.sleep(5)
+                self.wait(5)
+
+        self.status = 'Idle'
+
+    async def tick_async(self, tmr):
+        """
+        Simulation tick from an event loop, software awaits its API calls instead of blocking
+        :param tmr: time of tick
+        :return:
+        """
+        dtime = self.delta(tmr)
+
+        # Don't process unless system in on
+        if not self.parameter('powered'):
+            return
+
+        self.status = 'Running software'
+
+        # For all programs in system
+        for i, program in enumerate(self.__software):
+            self.status = 'Tick ' + program.__class__.__name__
+            await self.wait_async(0.1)
+
+            # Tick them
+            if not await program.tick_async(tmr, dtime):
+                self.__software.pop(i)
+                self.status = program.__class__.__name__+' crashed'
+                await self.wait_async(5)
 
         self.status = 'Idle'
 
@@ -201,13 +345,31 @@ class System:
         self.__params['powered'] = True
         self.status = 'Booting'
 
-        time.sleep(1)
+        self.wait(1)
 
         # Start all software in system
         for i in self.__software:
             self.status = "Starting " + i.__class__.__name__
             i.start()
-            time.sleep(1)
+            self.wait(1)
+
+        self.status = 'Idle'
+
+    async def boot_async(self):
+        """
+        Start the computer from an event loop
+        :return:
+        """
+        self.__params['powered'] = True
+        self.status = 'Booting'
+
+        await self.wait_async(1)
+
+        # Start all software in system
+        for i in self.__software:
+            self.status = "Starting " + i.__class__.__name__
+            await i.start_async()
+            await self.wait_async(1)
 
         self.status = 'Idle'
 
@@ -218,6 +380,10 @@ class System:
         """
         print("Powered off", self.get_serial())
         self.__params['powered'] = False
+
+        for software in self.__software:
+            software.stop()
+
         if crashed:
             self.status = "Crashed"
         else:
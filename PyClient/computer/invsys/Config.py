@@ -0,0 +1,119 @@
+def boolean(value):
+    """
+    Boolean from a config value, the database hands them back as text
+    :param value: config value
+    :return:
+    """
+    if isinstance(value, str):
+        return value.lower() in ('1', 't', 'true', 'yes')
+
+    return bool(value)
+
+
+class Config(dict):
+    """
+    Configuration of the inventory software
+
+    Values are converted to their type as they're set and every key set to a different value is
+        remembered, so only those are written back to the database
+    """
+
+    # Types of the known keys, str is default
+    types = {
+        'lastupdate': float,
+        'hbt': int,
+        'backoff': int,
+        'forceHTTPS': boolean,
+        'client_id': str,
+        'apikey': str,
+        'keypub': str
+    }
+
+    def __init__(self, values=None):
+        """
+        Initialize the configuration, every initial value counts as changed
+        :param values: dictionary of initial values
+        :return:
+        """
+        super().__init__()
+
+        # Changes whenever a value does
+        self.version = 0
+
+        # Keys set since the last save, in the order they were set
+        self.__changed = {}
+
+        if values:
+            self.update(values)
+
+    def typed(self, key, value):
+        """
+        Value as the type of its key
+        :param key: config key
+        :param value: config value
+        :return:
+        """
+        if value is None or key not in self.types:
+            return value
+
+        return self.types[key](value)
+
+    def __setitem__(self, key, value):
+        """
+        Set a value, nothing changes if it's the same as the current one
+        :param key: config key
+        :param value: config value
+        :return:
+        """
+        value = self.typed(key, value)
+
+        if key in self and dict.__getitem__(self, key) == value:
+            return
+
+        dict.__setitem__(self, key, value)
+        self.__changed[key] = True
+        self.version += 1
+
+    def update(self, *args, **kwargs):
+        """
+        Set many values
+        :return:
+        """
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def load(self, values):
+        """
+        Load values as the database has them, they don't have to be written back
+        :param values: dictionary of stored values
+        :return:
+        """
+        for key in values:
+            dict.__setitem__(self, key, self.typed(key, values[key]))
+            self.__changed.pop(key, None)
+
+        self.version += 1
+
+    @property
+    def changed(self):
+        """
+        Has anything changed since the last save
+        :return:
+        """
+        return bool(self.__changed)
+
+    def changes(self):
+        """
+        Keys which changed since the last save and their values
+        :return: list of key and value pairs
+        """
+        return [(key, self.get(key, None)) for key in self.__changed]
+
+    def clean(self, version=None):
+        """
+        Mark the configuration as saved
+        :param version: version that was saved, nothing is marked if it changed since
+        :return:
+        """
+        if version is None or version == self.version:
+            self.__changed.clear()
@@ -2,6 +2,7 @@
 import sys
 
 # Software imports
+from . import Config
 from . import RequestAPI
 from . import Logger
 from . import Software
@@ -15,7 +16,11 @@ import json
 import urllib.request
 import urllib.error
 import urllib.parse
-import collections
+import collections.abc
+
+
+# Returned by a response handler when the request has to be made again
+RETRY = object()
 
 
 def flatten(d, parent_key='', sep='_'):
@@ -29,7 +34,7 @@ def flatten(d, parent_key='', sep='_'):
     items = []
     for k, v in d.items():
         new_key = parent_key + sep + k if parent_key else k
-        if isinstance(v, collections.MutableMapping):
+        if isinstance(v, collections.abc.MutableMapping):
             items.extend(flatten(v, new_key, sep=sep).items())
         else:
             items.append((new_key, v))
@@ -49,6 +54,14 @@ class InvSys(Software.Software):
         """
         return RequestAPI.RequestApi
 
+    @property
+    def async_request(self):
+        """
+        Provide a request helper that returns the asyncio api object
+        :return:
+        """
+        return RequestAPI.AsyncRequestApi
+
     @property
     def sql(self):
         return self._sqlbroker
@@ -64,6 +77,13 @@ class InvSys(Software.Software):
         self.sql.close()
         return None
 
+    def now(self):
+        """
+        Current time according to the system clock, virtual when fast-forwarding the simulation
+        :return:
+        """
+        return self._kernel.clock.time()
+
     def sql_filepath(self):
         """
         Generate the sql filepath for this specific installation
@@ -105,29 +125,75 @@ class InvSys(Software.Software):
         Virtually start the software
         :return:
         """
+        if not self.prepare():
+            return
+
+        # Initialize inventory software
+        self.initialize()
+
+    async def start_async(self):
+        """
+        Virtually start the software from an event loop
+        :return:
+        """
+        if not self.prepare():
+            return
+
+        # Initialize inventory software
+        await self.initialize_async()
+
+    def prepare(self):
+        """
+        Load the configuration, logger and database location before initializing
+        :return:
+        """
         config = json.loads(self._filesystem.getfile('invconf'))
 
         # Make sure API name is friendly
         if urllib.parse.urlparse(config['api']).scheme != '':
             return self.crash("FOUND HTTP OR HTTPS IN API")
 
-        self._params['config'] = config
+        # Typed as it's set, only what changes is written back
+        self._params['config'] = Config.Config(config)
 
         self.config['lastupdate'] = 0
 
         # self._logger = Logger(self._filesystem,'error.log')
+        logdir = self.config.get('logdir', None)
         self._logger = Logger.Logger(self._filesystem,
                                      filename=self.config['logfile'],
-                                     loglevel=self.config['loglevel'])
+                                     loglevel=self.config['loglevel'],
+                                     maxsize=self.config.get('logsize', None),
+                                     rotate=self.config.get('logrotate', 0),
+                                     buffered=self.config.get('logasync', False),
+                                     capacity=self.config.get('logbuffer', 1000),
+                                     records=self.config.get('logrecords', 100),
+                                     path=os.path.join(logdir, self._kernel.get_serial() + '.log') if logdir else None)
 
         # Run parent starting code
         super().start()
 
-        sqlfp = os.path.join(self.config['sqlstore'], self._kernel.get_serial()) + ".db3"
-        self.sql.fp(sqlfp)
+        # Either one fleet database shared by every system or a file of our own
+        shards = self.config.get('sqlfleet', 0)
+        if shards:
+            self.sql.route(SqlBroker.open_fleet(self.config['sqlstore'], shards), self._kernel.get_serial())
+        else:
+            self.sql.fp(self.sql_filepath())
 
-        # Initialize inventory software
-        self.initialize()
+        # One connection for as long as the software runs
+        self.sql.connect(self.config.get('sqlsync', 'NORMAL'), self.config.get('sqlcache', 512),
+                         self.config.get('sqlmemory', False))
+
+        return True
+
+    def stop(self):
+        """
+        Stop the software and let go of its database
+        :return:
+        """
+        super().stop()
+
+        self.sql.disconnect()
 
     def initialize(self):
         """
@@ -154,6 +220,31 @@ class InvSys(Software.Software):
         self.post_inventory()
         return True
 
+    async def initialize_async(self):
+        """
+        Initialize the software from an event loop
+        :return:
+        """
+        if self._initialized:
+            return
+
+        self.log("Initializing")
+
+        # Create the DB if it doesn't exist, otherwise update configuration
+        if self.create_sqldb():
+            await self.update_config_async()
+
+        # Retrieve the configuration
+        self.get_config()
+
+        # Begin initial inventory
+        await self.init_inventory_async()
+
+        self._initialized = True
+
+        await self.post_inventory_async()
+        return True
+
     def tick(self, tmr, dtime):
         """
         The software simulation loop, what happens per tick
@@ -161,22 +252,43 @@ class InvSys(Software.Software):
         """
         if not self.started():
             return
-        config = self._params['config']
 
         # If not initialized, quit from ticking
         if not self._initialized:
             return
 
         # Time to send heartbeat?
-        if self.ram.get('last_hb', 0) + config['hbt'] < tmr:
-            self.ram.get('last_hb', None)
+        if self.heartbeat_due(tmr):
             self.heartbeat(tmr)
 
-        # print((tmr, dtime))
-        # print(self._params['config']['api'])
+        return True
+
+    async def tick_async(self, tmr, dtime):
+        """
+        The software simulation loop from an event loop
+        :return:
+        """
+        if not self.started():
+            return
+
+        # If not initialized, quit from ticking
+        if not self._initialized:
+            return
+
+        # Time to send heartbeat?
+        if self.heartbeat_due(tmr):
+            await self.heartbeat_async(tmr)
 
         return True
 
+    def heartbeat_due(self, tmr):
+        """
+        Is it time to send a heartbeat
+        :param tmr: time of tick
+        :return:
+        """
+        return self.ram.get('last_hb', 0) + self.config['hbt'] < tmr
+
     # SQL ACTIONS ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
     def create_sqldb(self):
@@ -193,42 +305,80 @@ class InvSys(Software.Software):
 
         return True
 
-    def dump_config_to_table(self, tmr=time.time()):
+    def dump_config_to_table(self, tmr=None):
         """
         Dump configuration to local db
         :param tmr: time of operation
         :return:
         """
+        if tmr is None:
+            tmr = self.now()
+
         self.log("Dumping config to DB")
         self.sql.dump_config_to_db(tmr, self.config)
 
-    def update_config(self, tmr=time.time(), config=None):
+    def update_config(self, tmr=None, config=None):
         """
         Update the configuration from remote API
         :param tmr: time of update
         :return:
         """
-
         # Get the remote configuration if none passed in
         if not config:
             # Get the remote configurations
             config = self.inv_rconf()
 
+        self.apply_config(tmr, config)
+
+    async def update_config_async(self, tmr=None, config=None):
+        """
+        Update the configuration from remote API from an event loop
+        :param tmr: time of update
+        :return:
+        """
+        # Get the remote configuration if none passed in
+        if not config:
+            # Get the remote configurations
+            config = await self.inv_rconf_async()
+
+        self.apply_config(tmr, config)
+
+    def apply_config(self, tmr, config):
+        """
+        Overwrite the local configuration with the remote one and save it
+        :param tmr: time of update
+        :param config: list of remote configuration attributes
+        :return:
+        """
+        if tmr is None:
+            tmr = self.now()
+
         self.log("Updating configuration")
 
-        # Overwrite current configuration for remote
+        # Overwrite current configuration for remote, values which are the same don't change it
         for i in config:
             self.config[i['attribute']] = i['value']
 
+        # Same configuration as before, nothing to write
+        if not self.config.changed:
+            return
+
         self.config['lastupdate'] = tmr
 
-        # Dump to db
-        self.sql.dump_config_to_db(tmr, self.config)
+        self.save_config()
+
+    def save_config(self):
+        """
+        Write the configuration keys which changed since the last save through to the local db
+        :return:
+        """
+        version = self.config.version
+        changes = self.config.changes()
+
+        if changes:
+            self.sql.save_config(changes)
 
-        # Clean up types
-        conf = self.sql.typeify_config(self.config)
-        for i in conf:
-            self.config[i] = conf[i]
+        self.config.clean(version)
 
     # API ACTIONS ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
@@ -242,9 +392,9 @@ class InvSys(Software.Software):
         # If the table doesn't exists
         if self.sql.exists():
             self.log("Loading configuration")
-            conf = self.sql.config()
-            for i in conf:
-                self.config[i] = conf[i]
+
+            # Read once, from here on it's served from memory and written through
+            self.config.load(self.sql.config())
 
             return self.config
 
@@ -254,16 +404,40 @@ class InvSys(Software.Software):
         :param tmr:
         :return:
         """
-        # Put to RAM when our next heartbeat should be
         data = self.inv_heartbeat()
 
+        if self.beat(tmr, data):
+            self.update_config(tmr, config=data['config'])
+
+    async def heartbeat_async(self, tmr):
+        """
+        InvSys heartbeat prepper from an event loop, a missing config is requested without blocking the loop
+        :param tmr:
+        :return:
+        """
+        data = await self.inv_heartbeat_async()
+
+        if self.beat(tmr, data):
+            await self.update_config_async(tmr, config=data['config'])
+
+    def beat(self, tmr, data):
+        """
+        Account for the heartbeat response
+        :param tmr: time of the heartbeat
+        :param data: heartbeat response data
+        :return: should the configuration of the response be applied
+        """
         self.log('Heartbeat as '+self.config.get('client_id', 'N/A'))
 
-        # Update local configuration with config from heartbeat
-        self.update_config(config=data['config'])
+        # The API didn't answer, try again once the backoff is over
+        if data is RETRY:
+            self.ram['last_hb'] = tmr - self.config['hbt'] + self.config.get('backoff', 1)
+            return False
 
         self.ram['last_hb'] = tmr
 
+        return True
+
     def init_inventory(self):
         """
         Get an initial capture of the underlying system and save it to the sql database and
@@ -271,66 +445,41 @@ class InvSys(Software.Software):
             future interactions
         :return:
         """
-        self.log("Gathering Initial Inventory")
-        kernel = self._kernel
-
-        self.sql.open()
-
-        # Template queries
-        create_module = 'INSERT INTO modules (`module`) VALUES (?)'
-
-        create_table = ('CREATE TABLE ',
-                        ' (property VARCHAR(100), '
-                        'cid TEXT,'
-                        'sid TEXT,'
-                        'value TEXT,'
-                        'updated_at datetime,'
-                        'sync_date datetime,'
-                        'sync_key VARCHAR(100),'
-                        'PRIMARY KEY (property, cid))')
-
-        insert_property = ('INSERT INTO ',
-                           ' (`property`, `cid`, `value`, `updated_at`, `sync_date`, `sync_key`) '
-                           'VALUES (?, ?, ?, ?, NULL, NULL)')
-
-        # Dynamically create module tables and insertions of data
-        modules = list(kernel.modules)
-        for i in modules:
-            if len(self.sql.execute('SELECT * FROM modules WHERE `module` = ?', [i]).fetchall()) == 0:
-                self.log("Creating inventory for " + i + " module")
-                self.sql.execute(create_module, [i])
-
-                # CREATE TABLE <module> (property ....
-                self.sql.execute(i.join(create_table))
-
-            for k in kernel.get_component(i):
-                # Get flattened list of components
-                flat_component = flatten(k.component)
-
-                for j in flat_component:
-                    rep = self.sql.execute('SELECT value FROM '+i+' WHERE cid = "'+k['cid']+'" and property = "'+j+'"')
-
-                    if len(rep.fetchall()) <= 0 and j != 'cid':
-                        opts = [j, k['cid'], flat_component[j], time.time()]
-                        self.sql.execute(i.join(insert_property), opts)
+        return self.apply_identifiers(self.inv_init(self.capture_inventory()))
 
-                self.sql.commit()
-
-        self.sql.close()
+    async def init_inventory_async(self):
+        """
+        Initial inventory from an event loop
+        :return:
+        """
+        return self.apply_identifiers(await self.inv_init_async(self.capture_inventory()))
 
-        self.log("Building inventory object")
+    def capture_inventory(self):
+        """
+        Save the underlying system to the sql database and build the inventory object for the API
+        :return:
+        """
+        self.log("Gathering Initial Inventory")
+        kernel = self._kernel
 
-        # Build inventory object for API
-        inventory = {}
+        # Flattened properties of every component, the cid is what they're stored under
+        modules = {}
         for i in kernel.modules:
-            if not inventory.get(i, None):
-                inventory[i] = []
+            modules[i] = [flatten(k.attributes()) for k in kernel.get_component(i)]
 
-            for j in kernel.get_component(i):
-                inventory[i].append(j.component)
+        # Every module table and property in one transaction, properties already stored are kept
+        for i in self.sql.capture_inventory(modules, self.now()):
+            self.log("Creating inventory for " + i + " module")
 
-        idents = self.inv_init(inventory)
+        # The inventory object for the API is exactly the modules, the system keeps them encoded
+        return RequestAPI.RawJSON(kernel.encode_modules())
 
+    def apply_identifiers(self, idents):
+        """
+        Keep the identifiers handed out by the inventory server
+        :param idents: identifiers from the initial inventory
+        :return:
+        """
         if not idents:
             return None
 
@@ -338,18 +487,30 @@ class InvSys(Software.Software):
         for i in idents:
             self.config[i] = idents[i]
 
-        self.sql.dump_config_to_db(time.time(), self.config)
+        self.config['lastupdate'] = self.now()
+        self.save_config()
 
     def post_inventory(self):
-        resp = self.inv_post()
+        """
+        Post inventory and bind the server ids to our components
+        :return:
+        """
+        self.apply_post(self.inv_post())
 
-        modules = resp['computer']['modules']
+    async def post_inventory_async(self):
+        """
+        Post inventory from an event loop
+        :return:
+        """
+        self.apply_post(await self.inv_post_async())
 
-        for i in modules:
-            opts = (i, modules[i])
-            for x in opts[1]:
-                self.sql.cidsid(i, x['cid'], x['sid'])
-                self.sql.syncmodule(i, x['sid'], time.time())
+    def apply_post(self, resp):
+        """
+        Bind the server ids from the post inventory response to our components
+        :param resp: post inventory response data
+        :return:
+        """
+        self.sql.sync_inventory(resp['computer']['modules'], self.now())
 
     # Inventory API Interactions ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
@@ -382,6 +543,26 @@ class InvSys(Software.Software):
         # Get configuration
         rconf, code = self.request.rconf(self.config, data)
 
+        return self.rconf_response(rconf, code)
+
+    async def inv_rconf_async(self):
+        """
+        Requesting configuration from an event loop
+        :return:
+        """
+        self.log("Getting remote configuration")
+
+        rconf, code = await self.async_request.rconf(self.config, self.inv_idents())
+
+        return self.rconf_response(rconf, code)
+
+    def rconf_response(self, rconf, code):
+        """
+        Handle the remote configuration response
+        :param rconf: response
+        :param code: http status code
+        :return:
+        """
         # If code is not OK(200)
         if code == 404:
             return self.crash("Could not connect to API")
@@ -398,16 +579,51 @@ class InvSys(Software.Software):
         """
         self.log("Sending Initial Inventory Data")
 
+        resp, code = self.request.init(self.config, self.inv_init_data(inventory))
+
+        idents = self.init_response(resp, code)
+        if idents is RETRY:
+            return self.inv_init(inventory)
+
+        return idents
+
+    async def inv_init_async(self, inventory):
+        """
+        Initial inventory from an event loop
+        :param inventory: entire system in inventory friendly structure
+        :return:
+        """
+        self.log("Sending Initial Inventory Data")
+
+        resp, code = await self.async_request.init(self.config, self.inv_init_data(inventory))
+
+        idents = self.init_response(resp, code)
+        if idents is RETRY:
+            return await self.inv_init_async(inventory)
+
+        return idents
+
+    def inv_init_data(self, inventory):
+        """
+        Build the initial inventory request data
+        :param inventory: entire system in inventory friendly structure
+        :return:
+        """
         data = {
             'computer': {
                 'modules': inventory
             }
         }
 
-        data = self.inv_idents(data)
-
-        resp, code = self.request.init(self.config, data)
+        return self.inv_idents(data)
 
+    def init_response(self, resp, code):
+        """
+        Handle the initial inventory response, RETRY if the request has to be made again
+        :param resp: response
+        :param code: http status code
+        :return:
+        """
         # Handle the error codes
         if code == 500:
             return self.crash(resp)
@@ -417,7 +633,7 @@ class InvSys(Software.Software):
                 if i['code'] == '0x0003':
                     self.config.pop('client_id', None)
                     self.config.pop('apikey', None)
-                    return self.inv_init(inventory)
+                    return RETRY
                 # ExistsInventory: Already exists in inventory, returns client_id
                 elif i['code'] == '0x000B':
                     self.log(i['type'] + "|" + i['message'], 3)
@@ -443,6 +659,17 @@ class InvSys(Software.Software):
 
         return resp['data']
 
+    async def inv_post_async(self):
+        """
+        Post inventory from an event loop
+        :return:
+        """
+        self.log("Finding post inventory")
+
+        resp, code = await self.async_request.post(self.config, self.inv_idents({}))
+
+        return resp['data']
+
     def inv_update(self, changes):
         """
         TODO: Interface between InvSys and RequestApi for update inventory
@@ -467,6 +694,31 @@ class InvSys(Software.Software):
         # Handle heartbeat request
         resp, code = self.request.heartbeat(self.config, data)
 
+        return self.heartbeat_response(resp, code)
+
+    async def inv_heartbeat_async(self, data=None):
+        """
+        Heartbeat from an event loop
+        :param data: dataobject
+        :return:
+        """
+        resp, code = await self.async_request.heartbeat(self.config, self.inv_idents(data if data else {}))
+
+        return self.heartbeat_response(resp, code)
+
+    def heartbeat_response(self, resp, code):
+        """
+        Handle the heartbeat response
+        :param resp: response
+        :param code: http status code
+        :return:
+        """
+        # Timed out or unreachable, the heartbeat backs off instead of crashing
+        if code == RequestAPI.RequestApi.UNREACHABLE:
+            for i in resp['errors']:
+                self.log(i, 1)
+            return RETRY
+
         # Handle error cases
         if code != 200:
             return self.crash(resp)
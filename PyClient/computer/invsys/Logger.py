@@ -1,3 +1,10 @@
+import collections
+import os
+import threading
+import time
+import weakref
+
+
 class Logger:
     """
     Logging application for Inventory
@@ -7,25 +14,63 @@ class Logger:
     2 - Warning
     3 - Notice
     4 - Info
+
+    Buffered loggers only queue records on the tick path, they're formatted and written in batches
+        by the background flusher
     """
 
-    def __init__(self, fs, filename=None, loglevel=3):
+    def __init__(self, fs, filename=None, loglevel=3, maxsize=None, rotate=0,
+                 buffered=False, capacity=1000, records=100, path=None):
         """
         Initialize the logger with the required parameters
         :param fs: Filesystem
         :param filename: filename of the log
         :param loglevel: Up to what level should the log write
+        :param maxsize: size the log is rotated at, None for no limit
+        :param rotate: how many rotated logs are kept
+        :param buffered: queue records and write them from the background flusher
+        :param capacity: how many unwritten records are queued before the oldest are dropped
+        :param records: how many of the latest records are kept in memory
+        :param path: real file to write to instead of the filesystem
         """
         self.levels = {0: 'FATAL', 1: 'ERROR', 2: 'WARNING', 3: 'Notice', 4: 'Info'}
         self.__filesystem = fs
         self.__loglevel = loglevel
         self.__logfile = filename
+        self.__path = path
+        self.__buffered = buffered
+
+        # Appending to a deque is atomic, so logging never waits on the flusher
+        self.__pending = collections.deque(maxlen=capacity)
+        self.__recent = collections.deque(maxlen=records)
+        self.__lock = threading.Lock()
+
+        if path:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
 
         # If filename exists, make sure the file exists
-        if filename:
-            log = self.__filesystem.getfile(filename)
-            if not log:
-                self.__filesystem.addfile(filename, '')
+        elif filename:
+            self.__filesystem.appendable(filename, maxsize, rotate)
+
+        if buffered:
+            register(self)
+
+    def format(self, msg, level):
+        """
+        Format a log record
+        :param msg: Message, error dictionary or string
+        :param level: The log level of the message
+        :return:
+        """
+        # Is msg an error object
+        if isinstance(msg, dict):
+            readable = msg['code'], ' | ', msg['type'], ": ", msg['message']
+
+            msg = (self.levels[level], "".join(readable))
+        else:
+            msg = (self.levels[level], " " + msg)
+
+        return "|".join(msg)
 
     def log(self, msg, level=3):
         """
@@ -38,16 +83,116 @@ class Logger:
         if level > self.__loglevel:
             return
 
-        # Is msg an error object
-        if isinstance(msg, dict):
-            readable = msg['code'], ' | ', msg['type'], ": ", msg['message']
+        if self.__buffered:
+            self.__pending.append((msg, level))
+            return
 
-            msg = (self.levels[level], "".join(readable))
-        else:
-            msg = (self.levels[level], " " + msg)
+        self.write([self.format(msg, level)])
 
-        # Write to logfile or print to console
-        if self.__logfile:
-            self.__filesystem.appendfile(self.__logfile, '\n' + "|".join(msg))
-        else:
-            print("|".join(msg))
\ No newline at end of file
+    def write(self, lines):
+        """
+        Write formatted records out
+        :param lines: list of formatted records
+        """
+        self.__recent.extend(lines)
+
+        # Write to logfile or print to console, buffered logs without a file are only kept in memory
+        if self.__path:
+            f = open(self.__path, 'a')
+            f.write(''.join('\n' + line for line in lines))
+            f.close()
+        elif self.__logfile:
+            self.__filesystem.appendfile(self.__logfile, ''.join('\n' + line for line in lines))
+        elif not self.__buffered:
+            for line in lines:
+                print(line)
+
+    def flush(self):
+        """
+        Format and write every queued record in one batch
+        """
+        # Batches have to be written in order
+        with self.__lock:
+            lines = []
+            while self.__pending:
+                try:
+                    msg, level = self.__pending.popleft()
+                except IndexError:
+                    break
+                lines.append(self.format(msg, level))
+
+            if lines:
+                self.write(lines)
+
+    def records(self):
+        """
+        The latest records, most recent last
+        :return:
+        """
+        self.flush()
+
+        return list(self.__recent)
+
+
+class LogFlusher(threading.Thread):
+    """
+    Writes out every buffered logger in the process every so often
+    """
+
+    def __init__(self, threadid, name, interval):
+        """
+        Initialize the flusher thread
+        :param threadid: thread id number
+        :param name: thread name
+        :param interval: seconds between flushes
+        :return:
+        """
+        threading.Thread.__init__(self, daemon=True)
+        self.threadid = threadid
+        self.name = name
+        self.interval = interval
+
+    def run(self):
+        """
+        Flush until the process exits
+        :return:
+        """
+        while True:
+            time.sleep(self.interval)
+            flush_all()
+
+
+# Every buffered logger in the process and the thread flushing them
+buffered = weakref.WeakSet()
+registry = threading.Lock()
+flusher = None
+interval = 0.5
+
+
+def register(logger):
+    """
+    Have a logger flushed in the background
+    :param logger: buffered Logger
+    :return:
+    """
+    global flusher
+
+    with registry:
+        buffered.add(logger)
+
+        # A forked process doesn't inherit the running thread
+        if flusher is None or not flusher.is_alive():
+            flusher = LogFlusher(0, "Log flusher", interval)
+            flusher.start()
+
+
+def flush_all():
+    """
+    Write out every buffered logger right away
+    :return:
+    """
+    with registry:
+        loggers = list(buffered)
+
+    for logger in loggers:
+        logger.flush()
@@ -1,18 +1,70 @@
 import time
 import ssl
+import asyncio
 import json
+import random
 import urllib.request
 import urllib.error
 import urllib.parse
+import http.client
 import http.cookiejar
 
 import sys
 
+
+class RawJSON:
+    """
+    Already encoded json which goes into a request as is
+    """
+
+    def __init__(self, encoded):
+        """
+        Wrap the encoded json
+        :param encoded: json string
+        """
+        self.encoded = encoded
+
+
+def dumps(data):
+    """
+    json.dumps which puts RawJSON in without decoding and encoding it again
+    :param data: request data
+    :return: json string
+    """
+    raw = {}
+    nonce = str(random.getrandbits(64))
+
+    def placeholder(obj):
+        """
+        Stand in for RawJSON while encoding, swapped for the real json afterwards
+        :param obj: object json can't encode
+        :return:
+        """
+        if not isinstance(obj, RawJSON):
+            raise TypeError(repr(obj) + " is not JSON serializable")
+
+        key = '\x00' + nonce + '.' + str(len(raw))
+        raw[json.dumps(key)] = obj.encoded
+        return key
+
+    encoded = json.dumps(data, default=placeholder)
+    for key in raw:
+        encoded = encoded.replace(key, raw[key], 1)
+
+    return encoded
+
+
 class RequestApi:
     """
     Request API for the inventory system
     """
 
+    # Seconds a request gets to connect and to get its response
+    timeout = 30
+
+    # Status code of requests which never got a response
+    UNREACHABLE = 0
+
     @staticmethod
     def dress_data(data, config):
         """
@@ -61,7 +113,7 @@ class RequestApi:
         }
 
         # Return the request
-        return urllib.request.Request(url, bytes(json.dumps(data), 'utf8'), headers, method="POST")
+        return urllib.request.Request(url, bytes(dumps(data), 'utf8'), headers, method="POST")
 
     @staticmethod
     def handle_response(response):
@@ -69,8 +121,15 @@ class RequestApi:
         From response return dictionary of the response if possible, otherwise a string
         :param response: urllib.response class
         """
-        # Get the resp
-        resp = response.read().decode('utf-8')
+        return RequestApi.decode(response.read())
+
+    @staticmethod
+    def decode(body):
+        """
+        From raw response body return dictionary of the response if possible, otherwise a string
+        :param body: bytes of the response body
+        """
+        resp = body.decode('utf-8')
         try:
             # Try to decode the json
             return json.loads(resp)
@@ -91,17 +150,38 @@ class RequestApi:
         # Try to get the request completed
         try:
             # Return the good request
-            return RequestApi.handle_response(opener.open(request)), 200
+            return RequestApi.handle_response(opener.open(request, timeout=RequestApi.timeout)), 200
         except urllib.error.HTTPError as err:
             # Return the data for errors with code
             return RequestApi.handle_response(err), err.code
         except ssl.CertificateError as err:
-            print("-"*50)
-            print("FATAL ERROR: Your api does not have a valid SSL certificate")
-            print(err)
-            print("-"*50)
-            sys.exit(1)
+            RequestApi.certificate_error(err)
+        except (OSError, http.client.HTTPException) as err:
+            # Refused, unreachable, timed out or answered with garbage
+            return RequestApi.unreachable(err)
+
+    @staticmethod
+    def unreachable(err):
+        """
+        Response of a request the API never answered
+        :param err: what went wrong
+        :return: error response and the unreachable status code
+        """
+        error = {'code': '0x0000', 'type': 'Unreachable', 'message': str(err) or err.__class__.__name__}
+
+        return {'errors': [error]}, RequestApi.UNREACHABLE
 
+    @staticmethod
+    def certificate_error(err):
+        """
+        There is no way to recover from a bad certificate
+        :param err: the certificate error
+        """
+        print("-"*50)
+        print("FATAL ERROR: Your api does not have a valid SSL certificate")
+        print(err)
+        print("-"*50)
+        sys.exit(1)
 
     @staticmethod
     def request(config, data):
@@ -122,7 +202,7 @@ class RequestApi:
         if code == 404:
             uri = urllib.parse.urlparse(config['api'])
             if uri.scheme == 'https' and not config.get('forceHTTPS', False):
-                config['api'] = 'http://' + uri.path
+                config['api'] = 'http://' + uri.netloc + uri.path
             else:
                 return resp, code
         elif code == 200:
@@ -200,3 +280,206 @@ class RequestApi:
         api = RequestApi.dress_data(data, config)
 
         return RequestApi.request(config, api)
+
+
+class AsyncRequestApi:
+    """
+    asyncio version of the request API, every request is a coroutine so thousands of them can be
+        in flight on one thread
+    """
+
+    # Bounds how many requests are in flight at once
+    slots = None
+
+    @staticmethod
+    def bound(limit):
+        """
+        Limit the amount of requests in flight at once
+        :param limit: maximum concurrent requests, None for no limit
+        """
+        AsyncRequestApi.slots = asyncio.Semaphore(limit) if limit else None
+
+    @staticmethod
+    async def read_body(reader, headers):
+        """
+        Read the body of a response according to its headers
+        :param reader: asyncio.StreamReader
+        :param headers: dictionary of lowercase response headers
+        """
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            body = b''
+            while True:
+                size = int((await reader.readline()).split(b';')[0].strip(), 16)
+                if size == 0:
+                    await reader.readline()
+                    return body
+
+                body += await reader.readexactly(size)
+                await reader.readline()
+
+        if 'content-length' in headers:
+            return await reader.readexactly(int(headers['content-length']))
+
+        return await reader.read()
+
+    @staticmethod
+    async def handle_request(url, data):
+        """
+        Actually handle the request with the API server over a plain asyncio stream
+        :param url: full url of the request
+        :param data: dictionary of api request
+        """
+        uri = urllib.parse.urlsplit(url)
+        secure = uri.scheme == 'https'
+        body = bytes(dumps(data), 'utf8')
+
+        head = ('POST ' + (uri.path or '/') + ' HTTP/1.1\r\n'
+                'Host: ' + uri.netloc + '\r\n'
+                'Content-Type: application/json\r\n'
+                'Cache-Control: no-cache\r\n'
+                'Content-Length: ' + str(len(body)) + '\r\n'
+                'Connection: close\r\n\r\n')
+
+        try:
+            connect = asyncio.open_connection(uri.hostname, uri.port or (443 if secure else 80),
+                                              ssl=ssl.create_default_context() if secure else None)
+            reader, writer = await asyncio.wait_for(connect, RequestApi.timeout)
+        except ssl.CertificateError as err:
+            RequestApi.certificate_error(err)
+        except (OSError, asyncio.TimeoutError) as err:
+            return RequestApi.unreachable(err)
+
+        try:
+            # A server which stalls would otherwise hold the coroutine forever
+            return await asyncio.wait_for(AsyncRequestApi.exchange(reader, writer, head.encode('latin-1') + body),
+                                          RequestApi.timeout)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError, IndexError) as err:
+            # Dropped or garbled responses are no answer at all, same as the sync client
+            return RequestApi.unreachable(err)
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def exchange(reader, writer, request):
+        """
+        Send a request and read its response
+        :param reader: asyncio.StreamReader
+        :param writer: asyncio.StreamWriter
+        :param request: bytes of the whole request
+        :return: response and status code
+        """
+        writer.write(request)
+        await writer.drain()
+
+        # HTTP/1.1 200 OK
+        status = (await reader.readline()).split()
+        if len(status) < 2 or not status[1].isdigit():
+            raise ValueError('Malformed status line: ' + repr(b' '.join(status)))
+
+        code = int(status[1])
+
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            key, _, value = line.partition(':')
+            headers[key.strip().lower()] = value.strip()
+
+        return RequestApi.decode(await AsyncRequestApi.read_body(reader, headers)), code
+
+    @staticmethod
+    async def request(config, data):
+        """
+        Generic request against the API
+        :param config:
+        :param data:
+        :return:
+        """
+        uri = urllib.parse.urlparse(config['api'])
+        if uri.scheme == '':
+            config['api'] = 'https://' + uri.path
+
+        # Actually bind the time of the request
+        data['meta']['timestamp'] = time.time()
+        url = RequestApi.urlbuilder(config['api'], data['meta']['action'])
+
+        # Do the request
+        if AsyncRequestApi.slots:
+            async with AsyncRequestApi.slots:
+                resp, code = await AsyncRequestApi.handle_request(url, data)
+        else:
+            resp, code = await AsyncRequestApi.handle_request(url, data)
+
+        # Figure out if we can test multiple schemas
+        if code == 404:
+            uri = urllib.parse.urlparse(config['api'])
+            if uri.scheme == 'https' and not config.get('forceHTTPS', False):
+                config['api'] = 'http://' + uri.netloc + uri.path
+            else:
+                return resp, code
+        else:
+            return resp, code
+
+        # Retry the request
+        return await AsyncRequestApi.request(config, data)
+
+    @staticmethod
+    async def init(config, data=None):
+        """
+        Initial Inventory
+        :param data: Inventory data
+        """
+        if not data:
+            data = {}
+
+        api = RequestApi.dress_data({'action': 'init', 'data': data}, config)
+
+        return await AsyncRequestApi.request(config, api)
+
+    @staticmethod
+    async def post(config, data=None):
+        """
+        Post Inventory
+        :param config: inventory configuration
+        """
+        if not data:
+            data = {}
+
+        data['action'] = 'post'
+
+        data = RequestApi.dress_data(data, config)
+
+        return await AsyncRequestApi.request(config, data)
+
+    @staticmethod
+    async def rconf(config, data=None):
+        """
+        Requesting Configuration
+        :param data: data object
+        """
+        if not data:
+            data = {}
+
+        data['action'] = 'rconf'
+
+        data = RequestApi.dress_data(data, config)
+
+        return await AsyncRequestApi.request(config, data)
+
+    @staticmethod
+    async def heartbeat(config, data=None):
+        """
+        Heartbeat
+        :param config: configuration
+        :param data:
+        :return:
+        """
+        if not data:
+            data = {}
+
+        data['action'] = 'hbt'
+
+        api = RequestApi.dress_data(data, config)
+
+        return await AsyncRequestApi.request(config, api)
@@ -36,6 +36,13 @@ class Software:
         """
         self._params['started'] = True
 
+    async def start_async(self):
+        """
+        Virtually start the software from an event loop, software without async work starts as usual
+        :return:
+        """
+        self.start()
+
     def stop(self):
         """
         Stop the application
@@ -43,6 +50,9 @@ class Software:
         """
         self._params['started'] = False
 
+        if self._logger:
+            self._logger.flush()
+
     def started(self):
         """
         Returns whether the software is online
@@ -69,6 +79,13 @@ class Software:
 
         return True
 
+    async def tick_async(self, tmr, dtime):
+        """
+        The software simulation loop from an event loop, software without async work ticks as usual
+        :return:
+        """
+        return self.tick(tmr, dtime)
+
     @property
     def config(self):
         return self._params['config']
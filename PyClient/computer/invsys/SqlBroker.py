@@ -1,45 +1,682 @@
+import collections
 import sqlite3
 import os
+import queue
+import re
+import threading
+import traceback
+import urllib.parse
+import weakref
+import zlib
+
+
+class InvalidIdentifier(Exception): pass
+
+
+# Plain table and index names, anything else never makes it into a statement
+identifier = re.compile(r'[A-Za-z_][A-Za-z0-9_]*\Z')
+
+
+def quote_identifier(name):
+    """
+    Quote a table or index name for a statement
+    :param name: identifier
+    :return: quoted identifier
+    """
+    if not isinstance(name, str) or not identifier.match(name) or name.lower().startswith('sqlite_'):
+        raise InvalidIdentifier(repr(name) + " is not a valid table name")
+
+    return '"' + name + '"'
+
+
+# Statements of every module table, by module name and whether it's a fleet table
+templates = {}
+
+
+def statements(module, fleet=False):
+    """
+    Statements of a module table, built once so sqlite3 finds every repeated one in its statement cache
+    :param module: module name
+    :param fleet: table of a fleet database, keyed by serial which is always the last parameter
+    :return: dictionary of statement name to sql
+    """
+    key = (module, fleet)
+    if key in templates:
+        return templates[key]
+
+    table = quote_identifier(module)
+    serial = ' AND serial = ?' if fleet else ''
+
+    sql = {
+        'create': 'CREATE TABLE IF NOT EXISTS ' + table + ' (' + ('serial TEXT, ' if fleet else '') +
+                  'property VARCHAR(100), '
+                  'cid TEXT,'
+                  'sid TEXT,'
+                  'value TEXT,'
+                  'updated_at datetime,'
+                  'sync_date datetime,'
+                  'sync_key VARCHAR(100),'
+                  'PRIMARY KEY (' + ('serial, ' if fleet else '') + 'property, cid))',
+        'insert': 'INSERT OR IGNORE INTO ' + table +
+                  ' (`property`, `cid`, `value`, `updated_at`, `sync_date`, `sync_key`' + (', `serial`' if fleet else '') +
+                  ') VALUES (?, ?, ?, ?, NULL, NULL' + (', ?' if fleet else '') + ')',
+        'index_cid': 'CREATE INDEX IF NOT EXISTS ' +
+                     (quote_identifier(module + '_serial_cid') + ' ON ' + table + ' (serial, cid)' if fleet else
+                      quote_identifier(module + '_cid') + ' ON ' + table + ' (cid)'),
+        'index_sid': 'CREATE INDEX IF NOT EXISTS ' + quote_identifier(module + '_sid') + ' ON ' + table + ' (sid)',
+        'sid': 'UPDATE ' + table + ' SET sid = ? WHERE cid == ?' + serial,
+        'synced': 'UPDATE ' + table + ' SET sync_date = ? WHERE sid == ?' + serial,
+        'synced_property': 'UPDATE ' + table + ' SET sync_date = ? WHERE sid == ? AND property == ?' + serial,
+        'unsynced': 'SELECT DISTINCT serial FROM ' + table + ' WHERE sid IS NULL'
+    }
+
+    return templates.setdefault(key, sql)
+
+
+# Size of the statement cache of every connection opened from now on
+cached_statements = 128
+
+
+def cache_statements(size):
+    """
+    Set how many statements each connection keeps prepared
+    :param size: statement cache size
+    :return:
+    """
+    global cached_statements
+    cached_statements = max(0, int(size))
+
+
+class ConnectionPool:
+    """
+    Fleet-wide cache of open SQLite connections
+
+    At most limit connections stay open, once there are more the least recently used idle ones
+        are closed and simply opened again the next time they're needed
+    """
+
+    def __init__(self, limit=128):
+        """
+        Initialize the pool
+        :param limit: how many connections are kept open
+        """
+        self.limit = limit
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__idle = collections.OrderedDict()
+        self.__busy = {}
+        self.__lock = threading.Lock()
+
+    def stats(self):
+        """
+        Counters to size the pool by
+        :return:
+        """
+        with self.__lock:
+            return {
+                'open': len(self.__idle) + len(self.__busy),
+                'limit': self.limit,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+    def acquire(self, fp, pragmas=()):
+        """
+        Get the connection to a database, it's only used by the caller until released
+        :param fp: filepath of the database
+        :param pragmas: statements run on a newly opened connection
+        :return: sqlite3 connection
+        """
+        with self.__lock:
+            conn = self.__idle.pop(fp, None)
+            if conn is not None:
+                self.hits += 1
+                self.__busy[fp] = conn
+                return conn
+
+            self.misses += 1
+
+        # Shared by whichever worker thread ticks the system, never by two at once
+        conn = sqlite3.connect(fp, check_same_thread=False, cached_statements=cached_statements)
+        for pragma in pragmas:
+            conn.execute(pragma)
+
+        with self.__lock:
+            self.__busy[fp] = conn
+            evicted = self.evict()
+
+        for old in evicted:
+            old.close()
+
+        return conn
+
+    def release(self, fp):
+        """
+        Done with a connection for now, it stays open until evicted
+        :param fp: filepath of the database
+        :return:
+        """
+        with self.__lock:
+            conn = self.__busy.pop(fp, None)
+            if conn is None:
+                return
+
+            self.__idle[fp] = conn
+            evicted = self.evict()
+
+        for old in evicted:
+            old.close()
+
+    def evict(self):
+        """
+        Take the least recently used idle connections out until the pool fits, the caller holds the lock
+            and closes them
+        :return: list of evicted connections
+        """
+        evicted = []
+        while self.__idle and len(self.__idle) + len(self.__busy) > self.limit:
+            evicted.append(self.__idle.popitem(last=False)[1])
+            self.evictions += 1
+
+        return evicted
+
+    def discard(self, fp):
+        """
+        Close the connection to a database if it's idle
+        :param fp: filepath of the database
+        :return:
+        """
+        with self.__lock:
+            conn = self.__idle.pop(fp, None)
+
+        if conn is not None:
+            conn.close()
+
+    def close(self):
+        """
+        Close every idle connection
+        :return:
+        """
+        with self.__lock:
+            idle = list(self.__idle.values())
+            self.__idle.clear()
+
+        for conn in idle:
+            conn.close()
+
+
+# Connections of every broker in this process
+pool = ConnectionPool()
+
+# Brokers whose database lives in memory, snapshotted together
+memory = weakref.WeakSet()
+memory_lock = threading.Lock()
+
+
+class Fleet:
+    """
+    Consolidated inventory database of many systems, split over shard files
+
+    Every table is keyed by serial, systems in different shards write at the same time while the systems
+        of one shard take turns on its connection
+    """
+
+    def __init__(self, path, shards):
+        """
+        Initialize the fleet database
+        :param path: folder the shards are kept in
+        :param shards: how many shard files the systems are spread over
+        """
+        self.path = path
+        self.shards = max(1, int(shards))
+        self.__locks = [threading.RLock() for _ in range(self.shards)]
+
+        if not os.path.isdir(path):
+            os.makedirs(path, exist_ok=True)
+
+    def shard(self, serial):
+        """
+        Shard a system is kept in, the same in every process
+        :param serial: system serial
+        :return:
+        """
+        return zlib.crc32(serial.encode()) % self.shards
+
+    def filepath(self, shard):
+        """
+        Filepath of a shard
+        :param shard: shard number
+        :return:
+        """
+        return os.path.join(self.path, 'inventory-' + str(shard) + '.db3')
+
+    def lock(self, shard):
+        """
+        Lock held by whichever system uses a shard
+        :param shard: shard number
+        :return:
+        """
+        return self.__locks[shard]
+
+    def query(self, query, params=()):
+        """
+        Run a read query on every shard, shards which don't have the table yet have no rows
+        :param query: sql query
+        :param params: query parameters
+        :return: list of the rows of every shard
+        """
+        rows = []
+
+        for shard in range(self.shards):
+            fp = self.filepath(shard)
+            if not os.path.exists(fp):
+                continue
+
+            with self.__locks[shard]:
+                conn = pool.acquire(fp)
+                try:
+                    rows.extend(conn.execute(query, params).fetchall())
+                except sqlite3.OperationalError as e:
+                    if 'no such table' not in str(e):
+                        raise
+                finally:
+                    pool.release(fp)
+
+        return rows
+
+    def unsynced(self, module):
+        """
+        Serials of the systems with components of a module the server hasn't given an id yet
+        :param module: module name
+        :return: sorted list of serials
+        """
+        return sorted(set(i[0] for i in self.query(statements(module, True)['unsynced'])))
+
+
+# Fleet databases opened in this process, by folder and shard count
+fleets = {}
+fleets_lock = threading.Lock()
+
+
+def open_fleet(path, shards):
+    """
+    Get the fleet database in a folder, every system in the process shares it
+    :param path: folder the shards are kept in
+    :param shards: how many shard files
+    :return: Fleet
+    """
+    key = (os.path.abspath(path), int(shards))
+
+    with fleets_lock:
+        if key not in fleets:
+            fleets[key] = Fleet(path, shards)
+
+        return fleets[key]
+
+
+class SqlWriter(threading.Thread):
+    """
+    Write-behind worker, applies the writes brokers queue up off the tick path
+
+    Whatever is queued by the time the worker gets to it is grouped per database, merged and written
+        in one transaction per database
+    """
+
+    def __init__(self, threadid, name, batch=1000):
+        """
+        Initialize the writer thread
+        :param threadid: thread id number
+        :param name: thread name
+        :param batch: most writes taken off the queue at once
+        :return:
+        """
+        threading.Thread.__init__(self, daemon=True)
+        self.threadid = threadid
+        self.name = name
+        self.__batch = batch
+        self.__queue = queue.Queue()
+
+    def put(self, broker, kind, data):
+        """
+        Queue a write
+        :param broker: SqlBroker it's for
+        :param kind: config or sync
+        :param data: what gets written
+        :return:
+        """
+        self.__queue.put((broker, kind, data))
+
+    def flush(self):
+        """
+        Wait until everything queued so far is written
+        :return:
+        """
+        if self.is_alive():
+            self.__queue.join()
+
+    def take(self):
+        """
+        Wait for writes and take everything queued, up to a batch
+        :return: list of broker, kind and data
+        """
+        writes = [self.__queue.get()]
+
+        while len(writes) < self.__batch:
+            try:
+                writes.append(self.__queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return writes
+
+    def run(self):
+        """
+        Write until the process exits
+        :return:
+        """
+        while True:
+            writes = self.take()
+
+            # Group per database, keeping the order and merging consecutive config writes
+            grouped = collections.OrderedDict()
+            for broker, kind, data in writes:
+                group = grouped.setdefault(broker, [])
+                if kind == 'config' and group and group[-1][0] == 'config':
+                    group[-1] = ('config', list(dict(group[-1][1] + data).items()))
+                else:
+                    group.append((kind, data))
+
+            for broker in grouped:
+                try:
+                    broker.apply(grouped[broker])
+                except:
+                    traceback.print_exc()
+
+            for _ in writes:
+                self.__queue.task_done()
+
+
+# Write-behind worker of this process, None writes on the tick path
+writer = None
+
+
+def write_behind(enabled):
+    """
+    Turn write-behind on or off for every broker in this process
+    :param enabled: start the writer
+    :return:
+    """
+    global writer
+
+    if not enabled:
+        if writer is not None:
+            writer.flush()
+        writer = None
+        return
+
+    # A forked process doesn't inherit the running thread
+    if writer is None or not writer.is_alive():
+        writer = SqlWriter(0, "SQL writer")
+        writer.start()
+
+
+def flush():
+    """
+    Wait until every queued write in this process is made
+    :return:
+    """
+    if writer is not None:
+        writer.flush()
+
+
+def snapshot_all():
+    """
+    Snapshot every in-memory database in this process to disk
+    :return:
+    """
+    with memory_lock:
+        brokers = list(memory)
+
+    for broker in brokers:
+        broker.snapshot()
+
+
+def limit(size):
+    """
+    Set how many connections the pool keeps open
+    :param size: maximum open connections
+    :return:
+    """
+    pool.limit = max(1, int(size))
+
 
 class SqlBroker:
     """
     This class is designed to be used only with InvSys.
+
+    Once connected the broker borrows its connection from the fleet-wide pool on open and hands it
+        back on close, so the database file is only opened again if the pool evicted it
+
+    In memory mode the database lives in a shared-cache memory database instead, which is copied
+        to the file on snapshots and when disconnected
+
+    Routed to a fleet database the tables hold many systems, so every query is limited to the serial
+        of ours
     """
 
     def __init__(self, fp=None, debug=False):
+        """
+        Initialize the broker
+        :param fp: filepath of the database
+        :param debug: print every query
+        """
         self.__debug=debug
         self._sqlfp = fp
         self.__conn = None
         self.__c = None
 
+        # Statements a pooled connection is set up with, None while not connected
+        self.__pragmas = None
+
+        # Connection keeping the in-memory database alive, None on disk
+        self.__memory = None
+
+        # Serial our rows are keyed by in a fleet database, None in a database of our own
+        self.__serial = None
+
+        # Held from open to close, the write-behind worker uses the broker too
+        self.__lock = threading.RLock()
+        self.__depth = 0
+
+        # Config values as they were last written to the database
+        self.__dumped = {}
+
+        # Config values queued for the write-behind worker but not written yet
+        self.__pending = {}
+        self.__pending_lock = threading.Lock()
+
     @property
     def sqlfp(self):
         return self._sqlfp
 
     def exists(self):
-        return os.path.exists(self._sqlfp)
+        """
+        Has the database been created
+        :return:
+        """
+        if self.__pragmas is None and self.__memory is None and self.__serial is None:
+            return os.path.exists(self._sqlfp)
+
+        # Connecting creates the file, so look for the tables instead
+        self.open()
+        try:
+            query = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'config'"
+            if self.__conn.execute(query).fetchone() is None:
+                return False
+
+            # Other systems made the fleet tables, we exist once our config is in them
+            if self.__serial is None:
+                return True
+
+            query = 'SELECT 1 FROM config WHERE serial = ? LIMIT 1'
+            return self.__conn.execute(query, self.params()).fetchone() is not None
+        finally:
+            self.close()
 
     def fp(self,fp=None):
+        if fp != self._sqlfp:
+            self.disconnect()
+            self.__dumped = {}
+
+            # A database of our own again
+            if self.__serial is not None:
+                self.__serial = None
+                self.__lock = threading.RLock()
+
         self._sqlfp = fp
 
+    def route(self, fleet, serial):
+        """
+        Keep the inventory in a fleet database instead of a file of our own
+        :param fleet: Fleet database
+        :param serial: serial of our system
+        :return:
+        """
+        shard = fleet.shard(serial)
+        self.fp(fleet.filepath(shard))
+
+        self.__serial = serial
+
+        # The systems of a shard share its connection, one at a time
+        self.__lock = fleet.lock(shard)
+
+    def connect(self, synchronous='NORMAL', cache_size=512, in_memory=False):
+        """
+        Use pooled connections, tuned for many small transactions
+        :param synchronous: sqlite synchronous pragma
+        :param cache_size: page cache in KiB
+        :param in_memory: keep the database in memory, loaded from the file if there is one
+        :return:
+        """
+        if self.__pragmas is not None or self.__memory is not None:
+            return
+
+        self.close()
+
+        # Fleet databases are shared, they stay on disk
+        if in_memory and self.__serial is None:
+            # Named after the file, so anything else in the process can open the same database
+            uri = 'file:' + urllib.parse.quote(self._sqlfp) + '?mode=memory&cache=shared'
+            self.__memory = sqlite3.connect(uri, uri=True, check_same_thread=False,
+                                            cached_statements=cached_statements)
+
+            if os.path.exists(self._sqlfp):
+                disk = sqlite3.connect(self._sqlfp)
+                disk.backup(self.__memory)
+                disk.close()
+
+            with memory_lock:
+                memory.add(self)
+            return
+
+        self.__pragmas = ('PRAGMA journal_mode=WAL',
+                          'PRAGMA synchronous=' + synchronous,
+                          'PRAGMA cache_size=' + str(-int(cache_size)))
+
+    def disconnect(self):
+        """
+        Stop using pooled connections and close ours, an in-memory database is snapshotted first
+        :return:
+        """
+        # Everything queued has to be written while we still can
+        if writer is not None and (self.__memory is not None or self.__pragmas is not None):
+            writer.flush()
+
+        if self.__memory is not None:
+            self.snapshot()
+
+            with memory_lock:
+                memory.discard(self)
+
+            with self.__lock:
+                self.close()
+                self.__memory.close()
+                self.__memory = None
+            return
+
+        if self.__pragmas is None:
+            return
+
+        self.close()
+        self.__pragmas = None
+
+        # The other systems of a fleet shard still use its connection
+        if self.__serial is None:
+            pool.discard(self._sqlfp)
+
+    def snapshot(self):
+        """
+        Copy the in-memory database to its file
+        :return:
+        """
+        if self.__memory is None:
+            return
+
+        # Not while an operation is half way
+        with self.__lock:
+            disk = sqlite3.connect(self._sqlfp)
+            try:
+                self.__memory.backup(disk)
+            finally:
+                disk.close()
+
     def open(self):
         if not self._sqlfp:
             raise ConnectionRefusedError("No Filepath ever declared")
 
+        # Only one thread uses the connection at a time
+        self.__lock.acquire()
+
         if self.__conn or self.__c:
+            self.__depth += 1
             return
 
-        self.__conn = sqlite3.connect(self.sqlfp)
-        self.__c = self.__conn.cursor()
+        try:
+            if self.__memory is not None:
+                self.__conn = self.__memory
+            elif self.__pragmas is not None:
+                self.__conn = pool.acquire(self._sqlfp, self.__pragmas)
+            else:
+                self.__conn = sqlite3.connect(self.sqlfp, cached_statements=cached_statements)
+
+            self.__c = self.__conn.cursor()
+        except:
+            self.__conn = self.__c = None
+            self.__lock.release()
+            raise
 
     def close(self):
         if not self.__conn:
             return
 
+        # Nested open, the outer close lets go
+        if self.__depth:
+            self.__depth -= 1
+            self.__lock.release()
+            return
+
         self.__c.close()
-        self.__conn.close()
+
+        # Pooled and in-memory connections stay open for the next time
+        if self.__pragmas is not None:
+            pool.release(self._sqlfp)
+        elif self.__memory is None:
+            self.__conn.close()
 
         self.__conn = self.__c = None
+        self.__lock.release()
 
     def execute(self,*args):
         try:
@@ -47,9 +684,21 @@ class SqlBroker:
                 print(*args)
             return self.__c.execute(*args)
         except:
+            # Don't hand a half done transaction back to the pool
+            if self.__conn:
+                self.__conn.rollback()
             self.close()
             raise
 
+    def begin(self):
+        """
+        Start a write transaction, fleet shards are shared with other processes so their write lock is
+            taken up front, waiting for it like any other, instead of failing half way through
+        :return:
+        """
+        if self.__serial is not None and not self.__conn.in_transaction:
+            self.execute('BEGIN IMMEDIATE')
+
     def commit(self):
         if self.__debug:
             print("Commit")
@@ -58,55 +707,239 @@ class SqlBroker:
     def create_module_table(self):
         # Create one
         self.open()
+        self.begin()
         c = self.__c
 
-        # Create the config table
-        query = 'CREATE TABLE config ' \
-                '(property VARCHAR(100) PRIMARY KEY, ' \
-                'value VARCHAR(200))'
-        self.execute(query)
-
-        # Create the config table
-        query = 'CREATE TABLE modules ' \
-                '(module VARCHAR(100) PRIMARY KEY)'
-        self.execute(query)
+        if self.__serial is None:
+            # Create the config table
+            query = 'CREATE TABLE config ' \
+                    '(property VARCHAR(100) PRIMARY KEY, ' \
+                    'value VARCHAR(200))'
+            self.execute(query)
+
+            # Create the config table
+            query = 'CREATE TABLE modules ' \
+                    '(module VARCHAR(100) PRIMARY KEY)'
+            self.execute(query)
+        else:
+            # Fleet tables, made by whichever system of the shard comes first
+            query = 'CREATE TABLE IF NOT EXISTS config ' \
+                    '(serial TEXT, ' \
+                    'property VARCHAR(100), ' \
+                    'value VARCHAR(200), ' \
+                    'PRIMARY KEY (serial, property))'
+            self.execute(query)
+
+            query = 'CREATE TABLE IF NOT EXISTS modules ' \
+                    '(serial TEXT, ' \
+                    'module VARCHAR(100), ' \
+                    'PRIMARY KEY (serial, module))'
+            self.execute(query)
 
         self.commit()
 
         self.close()
 
+        # Nothing has been written to the new database yet
+        self.__dumped = {}
+
     def dump_config_to_db(self,tmr,config):
         """
-        Dump configuration to local db
+        Dump configuration to local db, only what changed since the last dump is written and all of
+            it in one transaction
         :param tmr: time of operation
         :return:
         """
-        # Get the database
-        self.open()
+        rows = dict(config)
+        rows['lastupdate'] = str(tmr)
 
-        # General insert for configuration items
+        # The value column is text, so 5 and '5' are the same row
+        changed = [(i, rows[i]) for i in rows if self.__dumped.get(i, None) != str(rows[i])]
+        if not changed:
+            return
+
+        self.save_config(changed)
+
+    def save_config(self, rows):
+        """
+        Write config rows the caller knows changed, in one transaction or left to the write-behind worker
+        :param rows: list of property and value pairs
+        :return:
+        """
+        self.__dumped.update((i, str(value)) for i, value in rows)
+
+        # Leave it to the write-behind worker, config() sees it straight away
+        if self.queue('config', rows):
+            with self.__pending_lock:
+                self.__pending.update(rows)
+            return
+
+        self.apply([('config', rows)])
+
+    def write_config(self, rows):
+        """
+        Write config rows, the caller holds the connection and commits
+        :param rows: list of property and value pairs
+        :return:
+        """
         query = 'INSERT OR REPLACE INTO config (property, value) VALUES (?, ?)'
 
-        # Save configuration to sql table
-        for i in config:
-            opts = [i, config[i]]
+        if self.__serial is not None:
+            query = 'INSERT OR REPLACE INTO config (property, value, serial) VALUES (?, ?, ?)'
+            rows = [self.params(*row) for row in rows]
+
+        if self.__debug:
+            print(query, rows)
+        self.__c.executemany(query, rows)
+
+    def queue(self, kind, data):
+        """
+        Hand a write to the write-behind worker if there is one
+        :param kind: config or sync
+        :param data: what gets written
+        :return: False if it has to be written right away
+        """
+        if writer is None or (self.__memory is None and self.__pragmas is None):
+            return False
+
+        writer.put(self, kind, data)
+        return True
+
+    def apply(self, writes):
+        """
+        Apply writes in one transaction
+        :param writes: list of kind and data pairs, consecutive config writes are merged
+        :return:
+        """
+        self.open()
+
+        try:
+            self.begin()
+
+            for kind, data in writes:
+                if kind == 'config':
+                    self.write_config(data)
+                else:
+                    self.write_sync(*data)
 
-            self.execute(query, opts)
             self.commit()
+        except:
+            if self.__conn:
+                self.__conn.rollback()
 
-        # Update lastupdate case
-        opts = ['lastupdate', str(tmr)]
-        self.execute(query, opts)
-        self.commit()
+            # Nobody knows what made it in, the next dump writes everything again
+            self.__dumped = {}
+            raise
+        finally:
+            self.close()
 
-        # Close connections
-        self.close()
+            # Whatever was queued and is written now is read from the database
+            with self.__pending_lock:
+                for kind, data in writes:
+                    if kind == 'config':
+                        for i, value in data:
+                            if i in self.__pending and self.__pending[i] is value:
+                                del self.__pending[i]
+
+    def capture_inventory(self, modules, tmr):
+        """
+        Store the properties of every component in one transaction, properties which are already
+            stored keep their value
+        :param modules: dictionary of module name to list of flattened components
+        :param tmr: time of capture
+        :return: list of modules which didn't have a table yet
+        """
+        select_modules = 'SELECT `module` FROM modules'
+        insert_module = 'INSERT INTO modules (`module`) VALUES (?)'
+
+        # Fleet tables hold every system of the shard, keyed by serial
+        if self.__serial is not None:
+            select_modules = 'SELECT `module` FROM modules WHERE serial = ?'
+            insert_module = 'INSERT INTO modules (`module`, `serial`) VALUES (?, ?)'
+
+        self.open()
+
+        try:
+            self.begin()
+
+            known = set(i[0] for i in self.execute(select_modules, self.params()).fetchall())
+            created = [i for i in modules if i not in known]
+
+            self.__c.executemany(insert_module, [self.params(i) for i in created])
+
+            for i in modules:
+                sql = statements(i, self.__serial is not None)
+
+                # CREATE TABLE <module> (property ....
+                self.execute(sql['create'])
+                self.create_indexes(i)
+
+                rows = [self.params(j, k['cid'], k[j], tmr) for k in modules[i] for j in k if j != 'cid']
+                if self.__debug:
+                    print(sql['insert'], len(rows), "rows")
+                self.__c.executemany(sql['insert'], rows)
+
+            self.commit()
+        except:
+            if self.__conn:
+                self.__conn.rollback()
+            raise
+        finally:
+            self.close()
+
+        return created
+
+    def create_indexes(self, module):
+        """
+        Index a module table on the ids components are synced by, the caller holds the connection
+        :param module: module name
+        :return:
+        """
+        sql = statements(module, self.__serial is not None)
+
+        self.execute(sql['index_cid'])
+
+        # Also what finds components without a server id across the fleet
+        self.execute(sql['index_sid'])
+
+    def sync_inventory(self, modules, tmr):
+        """
+        Bind the server ids to our components and mark them synced, all in one transaction
+        :param modules: dictionary of module name to list of components with cid and sid
+        :param tmr: time of sync
+        :return:
+        """
+        if not self.queue('sync', (modules, tmr)):
+            self.apply([('sync', (modules, tmr))])
+
+    def write_sync(self, modules, tmr):
+        """
+        Write server ids and sync dates, the caller holds the connection and commits
+        :param modules: dictionary of module name to list of components with cid and sid
+        :param tmr: time of sync
+        :return:
+        """
+        for i in modules:
+            # Tables made before they were indexed
+            self.create_indexes(i)
+
+            sql = statements(i, self.__serial is not None)
+
+            ids = [(x['sid'], x['cid']) for x in modules[i]]
+            if self.__debug:
+                print("Sync", i, ids)
+
+            self.__c.executemany(sql['sid'], [self.params(sid, cid) for sid, cid in ids])
+            self.__c.executemany(sql['synced'], [self.params(str(tmr), sid) for sid, _ in ids])
 
     def config(self):
         self.open()
 
         # Get all of the results from the remote database
-        res = self.execute('SELECT * FROM config').fetchall()
+        if self.__serial is None:
+            res = self.execute('SELECT property, value FROM config').fetchall()
+        else:
+            res = self.execute('SELECT property, value FROM config WHERE serial = ?', self.params()).fetchall()
 
         self.close()
 
@@ -116,12 +949,18 @@ class SqlBroker:
         for i in res:
             config[i[0]] = i[1]
 
-        return self.typeify_config(config)
+        # Values still waiting on the write-behind worker, as the database will return them
+        with self.__pending_lock:
+            for i in self.__pending:
+                config[i] = None if self.__pending[i] is None else str(self.__pending[i])
+
+        # As stored, the software's Config gives them their types
+        return config
 
     def cidsid(self, module, cid, sid):
         self.open()
 
-        self.execute("UPDATE "+module+" SET sid = '"+sid+"' WHERE cid == '"+cid+"'")
+        self.execute(statements(module, self.__serial is not None)['sid'], self.params(sid, cid))
 
         self.commit()
 
@@ -135,10 +974,8 @@ class SqlBroker:
         #for row in rows.fetchall():
         #    self.sync(module, row[0], sid, tmr)
 
-        query = ("UPDATE ",module,
-                 " SET sync_date = '",str(tmr),
-                 "' WHERE sid == '"+sid+"'")
-        self.execute("".join(query))
+        query = statements(module, self.__serial is not None)['synced']
+        self.execute(query, self.params(str(tmr), sid))
 
         self.commit()
 
@@ -148,31 +985,19 @@ class SqlBroker:
         self.close()
 
     def sync(self, module, property, sid, tmr):
-        query = ("UPDATE ",module,
-                 " SET sync_date = '",str(tmr),
-                 "' WHERE sid == '"+sid+"' and property == '"+property+"'")
+        query = statements(module, self.__serial is not None)['synced_property']
 
-        self.execute("".join(query))
+        self.execute(query, self.params(str(tmr), sid, property))
 
         self.commit()
 
-    def typeify_config(self, config):
+    def params(self, *values):
         """
-        Helper for our code to have the configuration in the types we want it in, str is default
+        Parameters of a statement, fleet tables hold every system of the shard so our serial goes last
+        :param values: parameters of the statement
         :return:
         """
-        types = {
-            'lastupdate': float,
-            'hbt': int,
-            'backoff': int,
-            'forceHTTPS': bool,
-            'client_id': str,
-            'apikey': str,
-            'keypub': str
-        }
+        if self.__serial is None:
+            return values
 
-        for attr in config:
-            if attr in types:
-                config[attr] = types[attr](config[attr])
-
-        return config
+        return values + (self.__serial,)
@@ -44,4 +44,7 @@ def main():
     mgr.run()
 
 
-main()
+# Worker processes import this module, only the parent runs the simulation
+if __name__ == '__main__':
+    main()
+
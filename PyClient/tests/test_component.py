@@ -0,0 +1,81 @@
+import gc
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from ComponentPool import ComponentPool
+
+from computer import Component
+
+
+class ComponentTest(unittest.TestCase):
+
+    def block(self):
+        return {'name': 'Test Card', 'flags': ['a', 'b'], 'uplink': {'ipv4': '10.0.0.1'}, 'cid': 'AAA'}
+
+    def test_template_is_not_the_callers(self):
+        value = self.block()
+        a = Component.Component(self.block())
+        b = Component.Component(self.block())
+
+        a.component = value
+        value['flags'].append('MUT')
+        value['uplink']['ipv4'] = '0.0.0.0'
+
+        for c in (a, b):
+            self.assertEqual(c['flags'], ('a', 'b'))
+            self.assertEqual(c['uplink']['ipv4'], '10.0.0.1')
+
+        self.assertEqual(b.version, 0)
+
+    def test_constructed_from_callers_block(self):
+        value = self.block()
+        a = Component.Component(value)
+        value['flags'].append('MUT')
+
+        self.assertEqual(Component.Component(self.block())['flags'], ('a', 'b'))
+        self.assertEqual(a['flags'], ('a', 'b'))
+
+    def test_templates_released(self):
+        block = self.block()
+        block['name'] = 'Only One'
+        key = Component.template_key(block)
+
+        c = Component.Component(block)
+        self.assertIn(key, Component.templates)
+
+        del c
+        gc.collect()
+        self.assertNotIn(key, Component.templates)
+
+
+class ComponentPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.path, 'cpu'))
+
+        f = open(os.path.join(self.path, 'cpu', 'a.json'), 'w')
+        json.dump({'name': 'Pool CPU', 'cores': '4', 'serial': 'GEN'}, f)
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_keys_share_templates(self):
+        pool = ComponentPool(self.path)
+
+        block = pool.component('cpu', 0)
+        block['serial'] = 'SERIAL1'
+        block['cid'] = 'AAA'
+
+        c = Component.Component(block, pool.key('cpu', 0))
+        self.assertIs(Component.template(block), Component.template(pool.component('cpu', 0), pool.key('cpu', 0)))
+        self.assertEqual(c['serial'], 'SERIAL1')
+        self.assertEqual(c['cores'], '4')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import asyncio
+import socket
+import threading
+import unittest
+from unittest import mock
+
+from computer.invsys import RequestAPI
+
+
+class Reply:
+    """
+    Server which answers every connection with a fixed reply, or nothing at all, and hangs up
+    """
+
+    def __init__(self, reply=b''):
+        self.__reply = reply
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(8)
+        self.api = 'http://127.0.0.1:' + str(self.sock.getsockname()[1])
+        self.url = RequestAPI.RequestApi.urlbuilder(self.api, 'hbt')
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+
+            conn.recv(65536)
+            conn.sendall(self.__reply)
+            conn.close()
+
+    def close(self):
+        self.sock.close()
+
+
+class AsyncRequestApiTest(unittest.TestCase):
+
+    def handle(self, reply):
+        server = Reply(reply)
+        try:
+            return asyncio.run(RequestAPI.AsyncRequestApi.handle_request(server.url, {'meta': {}}))
+        finally:
+            server.close()
+
+    def test_closed_without_reply(self):
+        resp, code = self.handle(b'')
+
+        self.assertEqual(code, RequestAPI.RequestApi.UNREACHABLE)
+        self.assertEqual(resp['errors'][0]['type'], 'Unreachable')
+
+    def test_malformed_status_line(self):
+        resp, code = self.handle(b'garbage\r\n\r\n')
+
+        self.assertEqual(code, RequestAPI.RequestApi.UNREACHABLE)
+
+    def test_body_cut_short(self):
+        resp, code = self.handle(b'HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\n{"data"')
+
+        self.assertEqual(code, RequestAPI.RequestApi.UNREACHABLE)
+
+    def test_same_as_sync_client(self):
+        server = Reply()
+        try:
+            request = RequestAPI.RequestApi.create_request(server.api, {'meta': {'action': 'hbt'}})
+            self.assertEqual(RequestAPI.RequestApi.handle_request(request)[1], RequestAPI.RequestApi.UNREACHABLE)
+        finally:
+            server.close()
+
+    def test_answered(self):
+        resp, code = self.handle(b'HTTP/1.1 200 OK\r\nContent-Length: 11\r\n\r\n{"data": 1}')
+
+        self.assertEqual((resp, code), ({'data': 1}, 200))
+
+
+class RequestApiTest(unittest.TestCase):
+
+    def test_falls_back_to_http(self):
+        config = {'api': '127.0.0.1:9'}
+        replies = [({}, 404), ({'data': 1}, 200)]
+
+        with mock.patch.object(RequestAPI.RequestApi, 'handle_request', side_effect=replies) as handle:
+            self.assertEqual(RequestAPI.RequestApi.request(config, {'meta': {'action': 'hbt'}}), ({'data': 1}, 200))
+
+        self.assertEqual(config['api'], 'http://127.0.0.1:9')
+        self.assertEqual(handle.call_args[0][0].full_url, 'http://127.0.0.1:9/v1/hbt')
+
+    def test_same_fallback_as_async_client(self):
+        config = {'api': '127.0.0.1:9'}
+        replies = [({}, 404), ({'data': 1}, 200)]
+
+        with mock.patch.object(RequestAPI.AsyncRequestApi, 'handle_request', side_effect=replies):
+            asyncio.run(RequestAPI.AsyncRequestApi.request(config, {'meta': {'action': 'hbt'}}))
+
+        self.assertEqual(config['api'], 'http://127.0.0.1:9')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import http.server
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import urllib.request
+from unittest import mock
+
+from ComputerManager import Manager
+from Scheduler import AsyncScheduler
+from computer import Clock
+from computer import FileSystem
+from computer.invsys import RequestAPI
+
+
+class Inventory(http.server.BaseHTTPRequestHandler):
+    """
+    Inventory API whose heartbeats never carry a configuration, so the client has to request it
+    """
+
+    calls = []
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        action = self.path.rsplit('/', 1)[1]
+        self.calls.append(action)
+
+        if action == 'init':
+            data = {'identifiers': {'client_id': 'C1', 'apikey': 'K'}}
+        elif action == 'post':
+            data = {'computer': {'modules': {}}}
+        elif action == 'rconf':
+            data = {'config': [{'attribute': 'hbt', 'value': '1'}]}
+        else:
+            data = {'config': []}
+
+        body = json.dumps({'data': data}).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class AsyncSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = tempfile.mkdtemp()
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Inventory)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        Inventory.calls = []
+
+        FileSystem.share({'invconf': json.dumps({
+            'api': '127.0.0.1:' + str(self.server.server_address[1]),
+            'keypub': 'K',
+            'loglevel': 0,
+            'logfile': 'log.txt',
+            'sqlstore': self.store
+        })})
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.store)
+
+    def test_never_blocks_the_loop(self):
+        system = Manager.build_computer({'modules': {'bios': [{'serial': 'ASYNC1'}]}, 'filesystem': {}})
+        threads = Manager.simulators({'tickrate': 0.5, 'scheduler': 'asyncio', 'duration': 10},
+                                     {'ASYNC1': system}, Clock.VirtualClock())
+
+        # The stub speaks plain http, the client starts out on https
+        handle = RequestAPI.AsyncRequestApi.handle_request
+
+        async def plain(url, data):
+            return await handle(url.replace('https://', 'http://', 1), data)
+
+        with mock.patch.object(RequestAPI.AsyncRequestApi, 'handle_request', staticmethod(plain)), \
+                mock.patch.object(RequestAPI.RequestApi, 'request') as request, \
+                mock.patch.object(urllib.request.OpenerDirector, 'open') as urlopen:
+            scheduler = threads['scheduler']
+            self.assertIsInstance(scheduler, AsyncScheduler)
+            scheduler.start()
+            scheduler.join(30)
+            system.shutdown()
+
+        self.assertFalse(scheduler.is_alive())
+        self.assertEqual(request.call_count, 0)
+        self.assertEqual(urlopen.call_count, 0)
+
+        # Every heartbeat without a configuration requested it on the loop
+        self.assertGreater(Inventory.calls.count('hbt'), 1)
+        self.assertEqual(Inventory.calls.count('rconf'), Inventory.calls.count('hbt') + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()